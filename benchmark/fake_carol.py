@@ -0,0 +1,551 @@
+import json
+import logging
+import os
+import random
+import re
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from functools import reduce
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from functions import custom_pipeline
+
+logger = logging.getLogger(__name__)
+
+# Seconds (min, max) a task of each type takes. `default` is used for the other types.
+TASK_DURATIONS = {
+    'consolidate': (20, 60),
+    'process': (10, 40),
+    'delete': (2, 10),
+    'install': (10, 30),
+    'default': (1, 5),
+}
+
+# Probability of a task of each type failing.
+FAILURE_RATES = {
+    'default': 0.0,
+}
+
+
+def _new_id():
+    return uuid.uuid4().hex
+
+
+class FakeTenant:
+    """
+    State of a tenant in the fake Carol: stagings, DMs, ETLs, mappings, subscriptions and apps.
+    """
+
+    def __init__(self, name, records, app_version, connector_name='protheus_carol'):
+        relations = custom_pipeline.get_relations()
+        nodes = set(relations) | reduce(set.union, relations.values())
+        dms = sorted(i for i in nodes if i.startswith('DM_'))
+        stagings = sorted(i for i in nodes if not i.startswith('DM_'))
+
+        self.name = name
+        self.connector_name = connector_name
+        self.connector_id = _new_id()
+        self.app_version = app_version
+        self.records = {i: random.randint(*records) for i in stagings}
+        self.dms = {i.replace('DM_', ''): _new_id() for i in dms}
+        self.etls = {}
+        self.mappings = {}
+        self.subscriptions = {}
+        for staging in stagings:
+            etl_id = _new_id()
+            self.etls[etl_id] = {'mdmId': etl_id, 'mdmSourceEntityName': staging, 'mdmRunningState': 'RUNNING'}
+            # Each staging maps to the first DM depending on it.
+            dm = next((i for i in dms if staging in relations.get(i, ())), dms[0]).replace('DM_', '')
+            mapping_id = _new_id()
+            self.mappings[mapping_id] = {'mdmId': mapping_id, 'mdmStagingType': staging,
+                                         'mdmMasterEntityName': dm, 'mdmRunningState': 'RUNNING'}
+        for dm, dm_id in self.dms.items():
+            sub_id = _new_id()
+            self.subscriptions[sub_id] = {'mdmId': sub_id, 'mdmEntityTemplateId': dm_id,
+                                          'mdmEntityTemplateName': dm, 'mdmPaused': False}
+
+
+def make_certificate(directory, host='localhost'):
+    """
+    Self-signed certificate for `host` and 127.0.0.1, pycarol only speaks https.
+
+    Returns: str, str
+        Certificate and key files.
+    """
+    cert = os.path.join(directory, 'fake_carol.pem')
+    key = os.path.join(directory, 'fake_carol.key')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-keyout', key, '-out', cert, '-subj', f'/CN={host}',
+                    '-addext', f'subjectAltName=DNS:{host},IP:127.0.0.1'],
+                   check=True, capture_output=True)
+    return cert, key
+
+
+class FakeCarol:
+    """
+    Local HTTPS stand-in for the Carol and techfin APIs used by this project.
+
+    Tasks created by the API go READY -> RUNNING -> COMPLETED (or FAILED), with a duration drawn from
+    `task_durations` and failing with the probability in `failure_rates`. Task status is computed from
+    the clock, so there is no background thread. ETLs and mappings change state `state_lag` seconds
+    after being paused/played.
+
+    Every request is counted per tenant and route, see `calls`. Unknown routes answer an empty
+    success and are counted as `unmatched`.
+
+    Point the project to it with `CAROL_HOST`, `CAROL_PORT` and `TECHFIN_URL`, see `env`. The server
+    uses a self-signed certificate, trusted through `REQUESTS_CA_BUNDLE`.
+
+    Args:
+        tenants: list
+            Tenant names.
+        task_durations: dict
+            Task type -> (min, max) seconds. Types are `consolidate`, `process`, `delete`, `install`
+            and `default`.
+        failure_rates: dict
+            Task type -> probability of failing.
+        records: tuple
+            (min, max) number of records of each staging.
+        app_version: str
+            Version of the app installed in the tenants.
+        latest_version: str
+            Version of the app available to install.
+        state_lag: float
+            Seconds for an ETL/mapping to change state.
+        latency: float
+            Seconds added to every request.
+
+    """
+
+    def __init__(self, tenants, task_durations=None, failure_rates=None, records=(10000, 2000000),
+                 app_version='0.0.69', latest_version='0.0.70', state_lag=0.5, latency=0.0):
+        self.task_durations = dict(TASK_DURATIONS, **(task_durations or {}))
+        self.failure_rates = dict(FAILURE_RATES, **(failure_rates or {}))
+        self.latest_version = latest_version
+        self.state_lag = state_lag
+        self.latency = latency
+        self.tenants = {i: FakeTenant(i, records, app_version) for i in tenants}
+        self.tokens = {}  # access token / api key -> tenant.
+        self.tasks = {}
+        self.scrolls = {}  # scroll id -> offset of the next page.
+        self.calls = Counter()  # (tenant, route) -> number of calls.
+        self._pending_states = []  # (time, target dict, key, value)
+        self._lock = threading.RLock()
+        self._server = None
+        self._thread = None
+        self._certificate = None
+        self.routes = [
+            ('POST', r'v\d/oauth2/token', self.oauth_token),
+            ('POST', r'v\d/apiKey/issue', self.issue_api_key),
+            ('GET', r'v\d/organizations/current', self.current_org),
+            ('GET', r'v\d/tenants/current', self.current_tenant),
+            (None, r'v\d/apiKey/details', self.api_key_details),
+            (None, r'v\d/apiKey/revoke', self.api_key_revoke),
+            ('POST', r'v\d/queries/filter', self.query_filter),
+            ('POST', r'v\d/queries/filter/(?P<scroll_id>\w+)', self.query_scroll),
+            ('DELETE', r'v\d/queries/filter', self.query_delete),
+            ('GET', r'v\d/tasks/(?P<task_id>\w+)', self.get_task),
+            ('POST', r'v\d/tasks/(?P<task_id>\w+)/cancel', self.cancel_task),
+            ('POST', r'v\d/tasks/(?P<task_id>\w+)/reprocess', self.reprocess_task),
+            ('GET', r'v\d/connectors/name/(?P<name>[^/]+)', self.get_connector),
+            ('GET', r'v\d/connectors/(?P<connector_id>\w+)/stats', self.connector_stats),
+            ('GET', r'v\d/connectors/(?P<connector_id>\w+)/entityMappings.*', self.get_mappings),
+            ('POST', r'v\d/connectors/(?P<connector_id>\w+)/entityMappings/pause', self.pause_mappings),
+            ('POST', r'v\d/connectors/(?P<connector_id>\w+)/entityMappings/(?P<mapping_id>\w+)/play',
+             self.play_mapping),
+            ('POST', r'v\d/connectors/(?P<connector_id>\w+)/entityMappings/(?P<mapping_id>\w+)/pause',
+             self.pause_mapping),
+            ('GET', r'v\d/etl/connector/(?P<connector_id>\w+)', self.get_etls),
+            ('POST', r'v\d/etl/staging/(?P<connector_id>\w+)/(?P<staging>\w+)/(?P<action>play|pause)',
+             self.etl_action),
+            ('DELETE', r'v\d/etl/(?P<etl_id>\w+)', self.delete_etl),
+            ('DELETE', r'v\d/staging/tables/(?P<staging>\w+)', self.drop_staging),
+            ('POST', r'v\d/cds/staging/fetchCount', self.staging_count),
+            ('POST', r'v\d/cds/staging/consolidate', self.new_task('consolidate')),
+            ('POST', r'v\d/cds/staging/processData', self.new_task('process')),
+            ('POST', r'v\d/cds/staging/clearData', self.new_task('delete')),
+            ('POST', r'v\d/cds/golden/clearData', self.new_task('delete')),
+            ('POST', r'v\d/cds/rejected/clearData', self.new_task('delete')),
+            ('GET', r'v\d/entities/templates/name/(?P<name>\w+)', self.get_dm),
+            ('GET', r'v\d/subscription/template/(?P<dm_id>\w+)', self.get_subscriptions),
+            ('POST', r'v\d/subscription/(?P<sub_id>\w+)/(?P<action>pause|play|clear)', self.subscription_action),
+            ('GET', r'v\d/tenantApps', self.tenant_apps),
+            ('GET', r'v\d/tenantApps/name/(?P<name>\w+)', self.get_app),
+            ('GET', r'v\d/tenantApps/subscribableCarolApps', self.subscribable_apps),
+            ('POST', r'v\d/tenantApps/subscribe/carolApps/(?P<app_id>\w+)', self.subscribe_app),
+            ('POST', r'v\d/tenantApps/(?P<app_id>\w+)/install', self.install_app),
+            # techfin
+            ('POST', r'carol-sync/api/v1/subscription/subscribe', self.techfin_subscribe),
+            ('POST', r'provisioner/api/v1/carol-sync-monitoring/(?P<guid>[\w-]+)/delete-payments',
+             self.techfin_delete_payments),
+        ]
+        self.routes = [(method, re.compile(pattern), re.sub(r'\(\?P<(\w+)>[^)]*\)', r'{\1}', pattern), handler)
+                       for method, pattern, handler in self.routes]
+
+    @property
+    def url(self):
+        return f'https://localhost:{self._server.server_address[1]}'
+
+    @property
+    def env(self):
+        """
+        Environment variables pointing the project to this server.
+        """
+        return {'CAROL_HOST': 'localhost', 'CAROL_PORT': str(self._server.server_address[1]),
+                'TECHFIN_URL': self.url, 'REQUESTS_CA_BUNDLE': self._certificate[0],
+                'CAROLUSER': 'fake@carol.ai', 'CAROLPWD': 'fake', 'TOKEN_TECHFIN': 'fake'}
+
+    def start(self, host='127.0.0.1', port=0):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _handle(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                status, response = fake.dispatch(self.command, self.path, self.headers, body)
+                data = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._certificate = make_certificate(tempfile.mkdtemp(prefix='fake-carol-'))
+        # pip-system-certs replaces ssl.SSLContext with a client only (truststore) context.
+        context_class = next(i for i in ssl.SSLContext.__mro__ if i.__module__ == 'ssl')
+        context = context_class(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(*self._certificate)
+        self._server.socket = context.wrap_socket(self._server.socket, server_side=True)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # Dispatch.
+
+    def _tenant(self, headers, params):
+        for key in (headers.get('X-Auth-Key'), headers.get('Authorization', '').replace('Bearer ', '')):
+            if key and key in self.tokens:
+                return self.tenants[self.tokens[key]]
+        for key in ('subdomain', 'tenantId', 'domain'):
+            if params.get(key) in self.tenants:
+                return self.tenants[params[key]]
+        return None
+
+    def dispatch(self, method, path, headers, body):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlparse(path)
+        route = re.sub(r'^/?(api/)?', '', url.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        content_type = headers.get('Content-Type', '')
+        if body and 'json' in content_type:
+            data = json.loads(body)
+        elif body:
+            data = {k: v[-1] for k, v in parse_qs(body.decode()).items()}
+        else:
+            data = {}
+        if isinstance(data, dict):
+            params = dict(data, **params)
+
+        with self._lock:
+            self._apply_states()
+            tenant = self._tenant(headers, params)
+            tenant_name = tenant.name if tenant is not None else None
+            for route_method, pattern, name, handler in self.routes:
+                match = pattern.fullmatch(route)
+                if match and route_method in (None, method):
+                    self.calls[(tenant_name, name)] += 1
+                    try:
+                        return handler(tenant, params=params, data=data, **match.groupdict())
+                    except KeyError as e:
+                        return 404, {'errorCode': 404, 'errorMessage': f'not found: {e}'}
+            self.calls[(tenant_name, 'unmatched')] += 1
+            logger.warning(f'unmatched route {method} {route}')
+            return 200, {'success': True, 'hits': []}
+
+    # Tasks.
+
+    def _create_task(self, tenant, task_type, data=None):
+        task_id = _new_id()
+        self.tasks[task_id] = {'mdmId': task_id, 'tenant': tenant.name if tenant else None,
+                               'mdmTaskType': task_type, 'mdmData': data or {}, 'mdmUserId': 'fake'}
+        self._schedule(self.tasks[task_id])
+        return task_id
+
+    def _schedule(self, task):
+        task_type = task['mdmTaskType'] if task['mdmTaskType'] in self.task_durations else 'default'
+        task['started_at'] = time.time()
+        task['duration'] = random.uniform(*self.task_durations[task_type])
+        task['fails'] = random.random() < self.failure_rates.get(task_type, self.failure_rates['default'])
+        task['canceled'] = False
+
+    def _task_status(self, task):
+        elapsed = time.time() - task['started_at']
+        if task['canceled']:
+            return 'CANCELED'
+        if elapsed < min(1, task['duration']):
+            return 'READY'
+        if elapsed < task['duration']:
+            return 'RUNNING'
+        return 'FAILED' if task['fails'] else 'COMPLETED'
+
+    def _task_doc(self, task):
+        doc = {k: v for k, v in task.items() if k.startswith('mdm')}
+        doc['mdmTaskStatus'] = self._task_status(task)
+        doc['mdmLastUpdated'] = task['started_at']
+        return doc
+
+    def new_task(self, task_type):
+        def handler(tenant, **kwargs):
+            task_id = self._create_task(tenant, task_type)
+            return 200, {'taskId': task_id, 'data': {'mdmId': task_id}, 'mdmId': task_id}
+        return handler
+
+    def get_task(self, tenant, task_id, **kwargs):
+        return 200, self._task_doc(self.tasks[task_id])
+
+    def cancel_task(self, tenant, task_id, **kwargs):
+        self.tasks[task_id]['canceled'] = True
+        return 200, {'success': True}
+
+    def reprocess_task(self, tenant, task_id, **kwargs):
+        self._schedule(self.tasks[task_id])
+        return 200, {'mdmId': task_id}
+
+    def _matches(self, doc, filters):
+        for f in filters:
+            kind = f.get('mdmFilterType')
+            key = (f.get('mdmKey') or '').replace('.raw', '')
+            if kind == 'TYPE_FILTER':
+                if f['mdmValue'] != 'mdmTask':
+                    return False
+            elif kind == 'TERMS_FILTER':
+                if doc.get(key) not in f['mdmValue']:
+                    return False
+            elif kind == 'MATCH_FILTER':
+                if doc.get(key) != f['mdmValue']:
+                    return False
+        return True
+
+    def query_filter(self, tenant, params, data, **kwargs):
+        docs = [self._task_doc(task) for task in self.tasks.values()
+                if tenant is None or task['tenant'] == tenant.name]
+        docs = [doc for doc in docs if self._matches(doc, data.get('mustList', []))]
+        docs = [doc for doc in docs if not any(self._matches(doc, [f]) for f in data.get('mustNotList', []))]
+        docs.sort(key=lambda doc: doc['mdmLastUpdated'], reverse=True)
+        offset = int(params.get('offset', 0))
+        page_size = int(params.get('pageSize', 50))
+        hits = docs[offset:offset + page_size] if page_size >= 0 else docs[offset:]
+        r = {'hits': hits, 'count': len(hits), 'totalHits': len(docs)}
+        if str(params.get('scrollable')).lower() == 'true':
+            r['scrollId'] = _new_id()
+            self.scrolls[r['scrollId']] = offset + len(hits)
+        return 200, r
+
+    def query_scroll(self, tenant, params, data, scroll_id, **kwargs):
+        offset = self.scrolls.pop(scroll_id, None)
+        if offset is None:
+            return 404, {'errorCode': 404, 'errorMessage': f'scroll {scroll_id} not found'}
+        return self.query_filter(tenant, dict(params, offset=offset), data)
+
+    def query_delete(self, tenant, **kwargs):
+        return 200, {'success': True}
+
+    # Auth.
+
+    def oauth_token(self, tenant, params, **kwargs):
+        token = _new_id()
+        if tenant is not None:
+            self.tokens[token] = tenant.name
+        return 200, {'access_token': token, 'refresh_token': token, 'token_type': 'bearer', 'expires_in': 3600,
+                     'timeIssuedInMillis': int(time.time() * 1000), 'client_id': 'fake'}
+
+    def current_org(self, tenant, **kwargs):
+        return 200, {'mdmId': 'fake', 'mdmName': 'fake'}
+
+    def current_tenant(self, tenant, **kwargs):
+        if tenant is None:
+            return 404, {'errorCode': 404, 'errorMessage': 'tenant not found'}
+        return 200, {'mdmId': tenant.name, 'mdmName': tenant.name}
+
+    def issue_api_key(self, tenant, **kwargs):
+        key = _new_id()
+        if tenant is not None:
+            self.tokens[key] = tenant.name
+        return 200, {'X-Auth-Key': key, 'X-Auth-ConnectorId': tenant.connector_id if tenant else _new_id()}
+
+    def api_key_details(self, tenant, params, **kwargs):
+        key = params.get('apiKey')
+        if key is not None and key not in self.tokens:
+            return 401, {'errorCode': 401, 'errorMessage': 'Unauthorized'}
+        return 200, {'mdmApiKey': key}
+
+    def api_key_revoke(self, tenant, params, **kwargs):
+        self.tokens.pop(params.get('apiKey'), None)
+        return 200, {'success': True}
+
+    # Connectors, ETLs and mappings.
+
+    def _set_state(self, target, key, value):
+        self._pending_states.append((time.time() + self.state_lag, target, key, value))
+
+    def _apply_states(self):
+        now = time.time()
+        pending = []
+        for at, target, key, value in self._pending_states:
+            if at <= now:
+                target[key] = value
+            else:
+                pending.append((at, target, key, value))
+        self._pending_states = pending
+
+    def get_connector(self, tenant, name, **kwargs):
+        if name != tenant.connector_name:
+            raise KeyError(name)
+        return 200, {'mdmId': tenant.connector_id, 'mdmName': name}
+
+    def connector_stats(self, tenant, connector_id, **kwargs):
+        stats = {i: {'count': n} for i, n in tenant.records.items()}
+        return 200, {'aggs': {connector_id: {'stagingEntityStats': stats}}}
+
+    def get_mappings(self, tenant, params, **kwargs):
+        hits = list(tenant.mappings.values())
+        staging = params.get('stagingType') or params.get('entityTemplateType')
+        if staging is not None:
+            hits = [i for i in hits if i['mdmStagingType'] == staging]
+            if not hits:
+                return 404, {'errorCode': 404, 'errorMessage': 'Entity mapping not found'}
+        return 200, {'hits': hits, 'count': len(hits), 'totalHits': len(hits)}
+
+    def pause_mappings(self, tenant, data, **kwargs):
+        ids = data if isinstance(data, list) else data.get('entityMappingIds', list(tenant.mappings))
+        for mapping_id in ids:
+            self._set_state(tenant.mappings[mapping_id], 'mdmRunningState', 'PAUSED')
+        return 200, {'success': True}
+
+    def pause_mapping(self, tenant, mapping_id, **kwargs):
+        self._set_state(tenant.mappings[mapping_id], 'mdmRunningState', 'PAUSED')
+        return 200, {'success': True}
+
+    def play_mapping(self, tenant, mapping_id, **kwargs):
+        self._set_state(tenant.mappings[mapping_id], 'mdmRunningState', 'RUNNING')
+        return 200, {'success': True}
+
+    def get_etls(self, tenant, **kwargs):
+        return 200, list(tenant.etls.values())
+
+    def etl_action(self, tenant, staging, action, **kwargs):
+        state = 'RUNNING' if action == 'play' else 'PAUSED'
+        for etl in tenant.etls.values():
+            if etl['mdmSourceEntityName'] == staging:
+                self._set_state(etl, 'mdmRunningState', state)
+        return 200, {'success': True}
+
+    def delete_etl(self, tenant, etl_id, **kwargs):
+        tenant.etls.pop(etl_id, None)
+        return 200, {'success': True}
+
+    def drop_staging(self, tenant, staging, **kwargs):
+        task_id = self._create_task(tenant, 'delete')
+        return 200, {'taskId': task_id, 'mdmId': task_id}
+
+    def staging_count(self, tenant, params, **kwargs):
+        staging = params.get('stagingType') or params.get('stagingName')
+        return 200, {'count': tenant.records.get(staging, 0)}
+
+    # DMs and subscriptions.
+
+    def get_dm(self, tenant, name, **kwargs):
+        return 200, {'mdmId': tenant.dms[name], 'mdmName': name, 'mdmFields': [], 'mdmEntitySpace': 'PRODUCTION'}
+
+    def get_subscriptions(self, tenant, dm_id, **kwargs):
+        return 200, [i for i in tenant.subscriptions.values() if i['mdmEntityTemplateId'] == dm_id]
+
+    def subscription_action(self, tenant, sub_id, action, **kwargs):
+        sub = tenant.subscriptions[sub_id]
+        if action != 'clear':
+            sub['mdmPaused'] = action == 'pause'
+        return 200, {'success': True}
+
+    # Apps.
+
+    def _app(self, tenant, task_status='COMPLETED', task_id=None):
+        return {'mdmId': 'techfinplatform', 'mdmName': 'techfinplatform', 'mdmAppVersion': tenant.app_version,
+                'mdmInstallationTaskStatus': task_status, 'mdmInstallationTaskId': task_id}
+
+    def tenant_apps(self, tenant, **kwargs):
+        return 200, {'hits': [self._app(tenant)]}
+
+    def get_app(self, tenant, name, **kwargs):
+        return 200, self._app(tenant)
+
+    def subscribable_apps(self, tenant, **kwargs):
+        if tenant.app_version == self.latest_version:
+            return 200, {'hits': []}
+        return 200, {'hits': [{'mdmId': 'techfinplatform', 'mdmName': 'techfinplatform',
+                               'mdmAppVersion': self.latest_version}]}
+
+    def subscribe_app(self, tenant, app_id, **kwargs):
+        return 200, {'mdmId': app_id}
+
+    def install_app(self, tenant, app_id, **kwargs):
+        task_id = self._create_task(tenant, 'install', {'carolAppVersion': self.latest_version})
+        # The new version is seen as soon as the install is requested.
+        tenant.app_version = self.latest_version
+        return 200, {'mdmId': task_id}
+
+    # Techfin.
+
+    def techfin_subscribe(self, tenant, data, **kwargs):
+        self.calls[('techfin', 'subscribed')] += len(data.get('tenantIds', []))
+        return 200, {'success': True}
+
+    def techfin_delete_payments(self, tenant, guid, **kwargs):
+        return 200, {'success': True}
+
+    # Stats.
+
+    def calls_per_tenant(self):
+        """
+        Returns: dict
+            tenant -> number of requests.
+        """
+        r = defaultdict(int)
+        for (tenant, _), n in self.calls.items():
+            r[tenant] += n
+        return dict(r)
+
+    def calls_per_route(self):
+        """
+        Returns: dict
+            route -> number of requests.
+        """
+        r = defaultdict(int)
+        for (_, route), n in self.calls.items():
+            r[route] += n
+        return dict(r)
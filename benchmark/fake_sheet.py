@@ -0,0 +1,92 @@
+import threading
+from collections import Counter
+
+import gspread
+from gspread.utils import a1_to_rowcol
+
+from functions import sheet_utils
+
+N_COLS = sheet_utils.STATUS_COL
+
+
+class Cell:
+    def __init__(self, row, col, value):
+        self.row = row
+        self.col = col
+        self.value = value
+
+
+class FakeWorksheet:
+    """
+    In memory stand-in for the status worksheet, with the gspread methods used by `sheet_utils`.
+
+    Calls are counted per method, see `calls`.
+
+    Args:
+        tenants: list
+            Tenants, one per row, with an empty status.
+        sync_type: str
+            Sync type of all tenants.
+
+    """
+
+    def __init__(self, tenants, sync_type=''):
+        header = [''] * N_COLS
+        header[0] = sheet_utils.TENANT_HEADER
+        header[sheet_utils.SYNC_TYPE_COL - 1] = 'sync type'
+        header[sheet_utils.STATUS_COL - 1] = 'status'
+        self.rows = [header]
+        for tenant in tenants:
+            row = [''] * N_COLS
+            row[0] = tenant
+            row[sheet_utils.SYNC_TYPE_COL - 1] = sync_type
+            self.rows.append(row)
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def _set(self, row, col, value):
+        self.rows[row - 1][col - 1] = str(value)
+
+    def get_all_values(self):
+        self.calls['get_all_values'] += 1
+        with self._lock:
+            return [list(i) for i in self.rows]
+
+    def find(self, query):
+        self.calls['find'] += 1
+        with self._lock:
+            for row, values in enumerate(self.rows, start=1):
+                for col, value in enumerate(values, start=1):
+                    if value == query:
+                        return Cell(row, col, value)
+        raise gspread.CellNotFound(query)
+
+    def row_values(self, row):
+        self.calls['row_values'] += 1
+        with self._lock:
+            return list(self.rows[row - 1])
+
+    def cell(self, row, col):
+        self.calls['cell'] += 1
+        with self._lock:
+            return Cell(row, col, self.rows[row - 1][col - 1])
+
+    def update_cell(self, row, col, value):
+        self.calls['update_cell'] += 1
+        with self._lock:
+            self._set(row, col, value)
+
+    def batch_update(self, data, value_input_option=None):
+        self.calls['batch_update'] += 1
+        with self._lock:
+            for i in data:
+                row, col = a1_to_rowcol(i['range'])
+                self._set(row, col, i['values'][0][0])
+
+    def statuses(self):
+        """
+        Returns: dict
+            tenant -> status.
+        """
+        with self._lock:
+            return {i[0]: i[sheet_utils.STATUS_COL - 1] for i in self.rows[1:]}
@@ -0,0 +1,145 @@
+"""
+End-to-end benchmark of the reprocess against a fake Carol.
+
+For each concurrency level a fresh fake Carol and sheet are created with `--tenants` tenants, which are
+reprocessed by the engine. Reports per-tenant wall time, API calls and fleet throughput.
+
+    python -m benchmark.run --tenants 20 --concurrency 1,5,20 --time-scale 0.1
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+import uuid
+from collections import Counter
+
+from .fake_carol import FakeCarol, TASK_DURATIONS
+from .fake_sheet import FakeWorksheet
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+async def run_tenants(reprocess, tenants, index, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    wall_time = {}
+
+    async def _run(domain):
+        async with semaphore:
+            start = time.monotonic()
+            try:
+                await reprocess.run_tenant(domain, entry=index[domain])
+            finally:
+                wall_time[domain] = time.monotonic() - start
+
+    await asyncio.gather(*(_run(domain) for domain in tenants), return_exceptions=True)
+    return wall_time
+
+
+def run_level(args, concurrency, workdir):
+    # Imported here, the project reads the fake Carol address from the environment.
+    from functions import engine, journal, sizing, admission, sheet_utils, metrics
+
+    tenants = [f'tenant{uuid.uuid4().hex}' for _ in range(args.tenants)]
+    durations = {k: (low * args.task_scale, high * args.task_scale) for k, (low, high) in TASK_DURATIONS.items()}
+    fake = FakeCarol(tenants, task_durations=durations, failure_rates={'default': args.failure_rate},
+                     records=tuple(args.records), latency=args.latency, state_lag=args.state_lag)
+    fake.start(port=args.port)
+    os.environ.update(fake.env)
+    worksheet = FakeWorksheet(tenants, sync_type=args.sync_type)
+    path = os.path.join(workdir, str(concurrency))
+    os.makedirs(path)
+    spans = metrics.Metrics(os.path.join(path, 'spans.jsonl'), os.path.join(path, 'techfin_reprocess.prom'))
+    try:
+        reprocess = engine.Engine(max_tenants=concurrency, max_in_flight=args.max_in_flight,
+                                  journal=journal.Journal(os.path.join(path, 'journal.db')),
+                                  sizing=sizing.SizingHistory(os.path.join(path, 'sizing.db')),
+                                  admission=admission.AdmissionController(os.path.join(path, 'admission.db'),
+                                                                          capacity=args.admission_capacity),
+                                  worksheet=worksheet, sheet_interval=1, time_scale=args.time_scale,
+                                  metrics=spans)
+        index = sheet_utils.build_index(worksheet)
+        start = time.monotonic()
+        wall_time = asyncio.run(run_tenants(reprocess, tenants, index, concurrency))
+        total = time.monotonic() - start
+        reprocess.get_writer().stop()
+    finally:
+        fake.stop()
+
+    calls = fake.calls_per_tenant()
+    per_tenant = [calls.get(i, 0) for i in tenants]
+    times = list(wall_time.values())
+    return {
+        'concurrency': concurrency,
+        'tenants': len(tenants),
+        'wall_time': round(total, 2),
+        'tenants_per_hour': round(len(tenants) / total * 3600, 2),
+        'tenant_wall_time': {'min': round(min(times), 2), 'median': round(statistics.median(times), 2),
+                             'p90': round(percentile(times, 90), 2), 'max': round(max(times), 2)},
+        'api_calls': sum(calls.values()),
+        'api_calls_per_tenant': {'median': statistics.median(per_tenant), 'max': max(per_tenant)},
+        'api_calls_per_route': dict(Counter(fake.calls_per_route()).most_common()),
+        'sheet_calls': dict(worksheet.calls),
+        'status': dict(Counter(worksheet.statuses().values())),
+        'tasks': len(fake.tasks),
+        'phases': spans.summary(),
+    }
+
+
+def print_report(results):
+    print(f"{'concurrency':>11} {'tenants':>7} {'wall (s)':>9} {'tenants/h':>9} {'median (s)':>10} "
+          f"{'p90 (s)':>8} {'max (s)':>8} {'api calls':>9} {'calls/tenant':>12}")
+    for r in results:
+        t = r['tenant_wall_time']
+        print(f"{r['concurrency']:>11} {r['tenants']:>7} {r['wall_time']:>9} {r['tenants_per_hour']:>9} "
+              f"{t['median']:>10} {t['p90']:>8} {t['max']:>8} {r['api_calls']:>9} "
+              f"{r['api_calls_per_tenant']['median']:>12}")
+    for r in results:
+        print(f"\nconcurrency {r['concurrency']}: status {r['status']}, sheet calls {r['sheet_calls']}")
+        for route, n in list(r['api_calls_per_route'].items())[:10]:
+            print(f'    {n:>7} {route}')
+        print(f"    {'phase':<20} {'count':>5} {'total (s)':>9} {'max (s)':>8} {'tasks':>5} {'retries':>7}")
+        for phase, p in sorted(r['phases'].items(), key=lambda i: -i[1]['duration']):
+            print(f"    {phase:<20} {p['count']:>5} {p['duration']:>9.1f} {p['max']:>8.1f} {p['tasks']:>5} "
+                  f"{p['retries']:>7}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the reprocess against a fake Carol.')
+    parser.add_argument('--tenants', type=int, default=10, help='Number of tenants per level.')
+    parser.add_argument('--concurrency', default='1,5,10',
+                        help='Comma separated max number of tenants running at the same time.')
+    parser.add_argument('--time-scale', type=float, default=0.1, help='Factor applied to the engine sleeps.')
+    parser.add_argument('--task-scale', type=float, default=0.1, help='Factor applied to the task durations.')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Probability of a task failing.')
+    parser.add_argument('--records', type=int, nargs=2, default=[10000, 2000000],
+                        help='Min and max number of records per staging.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every API call.')
+    parser.add_argument('--state-lag', type=float, default=0.5,
+                        help='Seconds for an ETL/mapping to change state.')
+    parser.add_argument('--sync-type', default='', help='Sync type of the tenants, e.g. painel.')
+    parser.add_argument('--max-in-flight', type=int, default=8,
+                        help='Max number of stagings processing at the same time per tenant.')
+    parser.add_argument('--admission-capacity', type=int, default=32,
+                        help='Max sum of the weights of the heavy tasks in flight.')
+    parser.add_argument('--port', type=int, default=8765, help='Port of the fake Carol.')
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='techfin-benchmark-')
+    # Keep the API keys of the fake tenants out of the real cache.
+    os.environ['CAROL_KEY_CACHE'] = os.path.join(workdir, 'api_keys.json')
+    os.environ.pop('SLACK', None)
+
+    results = [run_level(args, int(i), workdir) for i in args.concurrency.split(',')]
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
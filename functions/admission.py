@@ -0,0 +1,159 @@
+import logging
+import sqlite3
+import time
+from contextlib import closing
+
+from . import carol_task
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS slots (
+    ticket INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT UNIQUE NOT NULL,
+    tenant TEXT,
+    weight INTEGER NOT NULL,
+    admitted INTEGER NOT NULL DEFAULT 0,
+    task_id TEXT,
+    queued_at REAL NOT NULL,
+    seen_at REAL NOT NULL,
+    admitted_at REAL
+);
+"""
+
+
+def get_weight(n_records, records_per_unit=2000000, max_weight=16):
+    """
+    Weight of a task, from the number of records it will process.
+    """
+    return min(max_weight, 1 + int(n_records // records_per_unit))
+
+
+class AdmissionController:
+    """
+    Fleet-wide cap on heavy Carol tasks (consolidate, process data).
+
+    Before creating a heavy task, a worker asks for a slot with the task weight. Slots are admitted in
+    arrival order while the sum of the weights in flight fits in `capacity`. The ledger is a SQLite
+    database, so it is shared by all threads and processes using the same file.
+
+    Queued requests not seen for `stale_after` seconds (the worker died) are dropped. Admitted slots are
+    released when their task finishes and when the tenant run ends, `reconcile` releases the ones whose
+    task is no longer READY or RUNNING in Carol. Admitted slots older than `admitted_ttl` seconds are
+    dropped, so a slot leaked by a process that died does not hold capacity forever.
+
+    Args:
+        path: str
+            SQLite database file.
+        capacity: int
+            Max sum of the weights of the admitted tasks.
+        stale_after: float
+            Seconds after which a queued request not polled again is dropped.
+        admitted_ttl: float
+            Seconds after which an admitted slot is dropped, whatever the state of its task.
+
+    """
+
+    def __init__(self, path='admission.db', capacity=32, stale_after=600, admitted_ttl=6 * 3600):
+        self.path = path
+        self.capacity = capacity
+        self.stale_after = stale_after
+        self.admitted_ttl = admitted_ttl
+        with closing(self._connect()) as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    def try_acquire(self, key, weight, tenant=None):
+        """
+        Queue a request for a slot (if not queued yet) and check if it is admitted.
+
+        Args:
+            key: str
+                Unique key of the request, e.g. `tenant/staging/process`.
+            weight: int
+                Weight of the task.
+            tenant: str
+                Tenant name.
+
+        Returns: bool
+            True if admitted.
+
+        """
+        weight = min(weight, self.capacity)
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM slots WHERE admitted = 0 AND seen_at < ?", (now - self.stale_after,))
+                conn.execute("DELETE FROM slots WHERE admitted = 1 AND admitted_at < ?", (now - self.admitted_ttl,))
+                conn.execute("INSERT OR IGNORE INTO slots (key, tenant, weight, queued_at, seen_at) "
+                             "VALUES (?, ?, ?, ?, ?)", (key, tenant, weight, now, now))
+                conn.execute("UPDATE slots SET seen_at = ? WHERE key = ?", (now, key))
+
+                ticket, admitted = conn.execute("SELECT ticket, admitted FROM slots WHERE key = ?", (key,)).fetchone()
+                if not admitted:
+                    in_flight = conn.execute("SELECT COALESCE(SUM(weight), 0) FROM slots WHERE admitted = 1").fetchone()[0]
+                    ahead = conn.execute("SELECT COALESCE(SUM(weight), 0) FROM slots WHERE admitted = 0 AND ticket < ?",
+                                         (ticket,)).fetchone()[0]
+                    # First come first served: requests ahead in the queue go first.
+                    if in_flight + ahead + weight <= self.capacity or (in_flight == 0 and ahead == 0):
+                        conn.execute("UPDATE slots SET admitted = 1, admitted_at = ? WHERE key = ?", (now, key))
+                        admitted = 1
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return bool(admitted)
+
+    def attach(self, key, task_id):
+        """
+        Record the Carol task created with the slot `key`.
+        """
+        with closing(self._connect()) as conn:
+            conn.execute("UPDATE slots SET task_id = ? WHERE key = ?", (task_id, key))
+
+    def release(self, key):
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM slots WHERE key = ?", (key,))
+
+    def release_tasks(self, task_ids):
+        task_ids = list(task_ids)
+        if not task_ids:
+            return
+        with closing(self._connect()) as conn:
+            conn.executemany("DELETE FROM slots WHERE task_id = ?", [(i,) for i in task_ids])
+
+    def release_tenant(self, tenant):
+        """
+        Release all the slots, admitted or queued, of `tenant`.
+        """
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM slots WHERE tenant = ?", (tenant,))
+
+    def in_flight(self):
+        """
+        Returns: int, int
+            Sum of the weights admitted, sum of the weights queued.
+        """
+        with closing(self._connect()) as conn:
+            r = conn.execute("SELECT admitted, COALESCE(SUM(weight), 0) FROM slots GROUP BY admitted").fetchall()
+        r = dict(r)
+        return r.get(1, 0), r.get(0, 0)
+
+    def reconcile(self, login, max_age=3600):
+        """
+        Release the slots of `login.domain` whose task is not READY/RUNNING anymore, or that were admitted
+        more than `max_age` seconds ago and never got a task.
+        """
+        with closing(self._connect()) as conn:
+            slots = conn.execute("SELECT key, task_id, admitted_at FROM slots WHERE admitted = 1 AND tenant = ?",
+                                 (login.domain,)).fetchall()
+
+        status = carol_task.get_tasks_status(login, [task_id for _, task_id, _ in slots if task_id is not None])
+        now = time.time()
+        for key, task_id, admitted_at in slots:
+            if task_id is None and now - admitted_at > max_age:
+                self.release(key)
+            elif task_id is not None and status.get(task_id, 'RUNNING') not in ('READY', 'RUNNING'):
+                logging.getLogger(login.domain).debug(f"releasing slot of {task_id}, {status[task_id]}")
+                self.release(key)
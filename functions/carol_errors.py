@@ -0,0 +1,20 @@
+import json
+
+from pycarol.exceptions import CarolApiResponseException
+
+
+def error_code(e):
+    """
+    Status code of the Carol response that raised `e`, None if it is not an API error.
+    """
+    if not isinstance(e, CarolApiResponseException):
+        return None
+    response = getattr(e, 'response', None)
+    if response is not None and getattr(response, 'status_code', None) is not None:
+        return response.status_code
+    # pycarol raises with the response body, {"errorCode": ..., "errorMessage": ...}.
+    try:
+        body = json.loads(e.args[0])
+    except (IndexError, TypeError, ValueError):
+        return None
+    return body.get('errorCode') if isinstance(body, dict) else None
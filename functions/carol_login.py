@@ -1,13 +1,154 @@
 from pycarol import Carol, ApiKeyAuth, PwdAuth, Tasks
+from pycarol.exceptions import CarolApiResponseException
+from joblib import Parallel, delayed
+import json
+import logging
 import os
+import threading
+import time
 
+from .carol_errors import error_code
 
-def get_login(domain, org, carol_app):
+CACHE_PATH = os.environ.get('CAROL_KEY_CACHE', os.path.expanduser('~/.techfin_reprocess/api_keys.json'))
+API_KEY_TTL = 24 * 3600  # mint a new key after this many seconds.
+VALIDATION_TTL = 30 * 60  # do not validate again a key checked less than this many seconds ago.
+
+_lock = threading.Lock()
+_validated = {}  # cache key -> last time the api key was validated.
+
+
+def _carol(domain, org, carol_app, auth, connector_id=None):
+    # CAROL_HOST/CAROL_PORT point to another Carol host, e.g. the fake server used by the benchmark.
+    host = {}
+    if os.environ.get('CAROL_HOST'):
+        host = {'host': os.environ['CAROL_HOST'], 'port': int(os.environ.get('CAROL_PORT', 443))}
+    return Carol(domain, carol_app, auth=auth, connector_id=connector_id, organization=org, **host)
+
+
+def _load_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {'keys': {}, 'stale': []}
+
+
+def _save_cache(path, cache):
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    tmp = f'{path}.tmp'
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp, path)
+
+
+def _is_valid(login, api_key, connector_id):
+    try:
+        login.api_key_details(api_key, connector_id)
+        return True
+    except CarolApiResponseException as e:
+        if error_code(e) == 401:
+            return False
+        raise
+
+
+def _issue_api_key(domain, org, carol_app):
     email = os.environ['CAROLUSER']
     password = os.environ['CAROLPWD']
-    login = Carol(domain, carol_app, auth=PwdAuth(email, password), organization=org, )
+    login = _carol(domain, org, carol_app, PwdAuth(email, password))
     api_key = login.issue_api_key()
+    return {'api_key': api_key['X-Auth-Key'], 'connector_id': api_key['X-Auth-ConnectorId'],
+            'created_at': time.time()}
+
+
+def get_login(domain, org, carol_app, ttl=API_KEY_TTL, cache_path=CACHE_PATH):
+    """
+    Carol login using an API key, reusing the cached one for the tenant while it is valid.
+
+    Args:
+        domain: str
+            Tenant name.
+        org: str
+            Organization name.
+        carol_app: str
+            Carol app name.
+        ttl: float
+            Seconds an API key is reused before minting a new one.
+        cache_path: str
+            File with the cached API keys, only readable by the current user.
+
+    Returns: pycarol.Carol
+        Carol() instance.
+
+    """
+    key = f'{org}/{domain}/{carol_app}'
+    with _lock:
+        entry = _load_cache(cache_path)['keys'].get(key)
+
+    if entry is not None and time.time() - entry['created_at'] < ttl:
+        login = _carol(domain, org, carol_app, ApiKeyAuth(entry['api_key']), connector_id=entry['connector_id'])
+        if time.time() - _validated.get(key, 0) < VALIDATION_TTL or \
+                _is_valid(login, entry['api_key'], entry['connector_id']):
+            _validated[key] = time.time()
+            return login
+
+    new_entry = _issue_api_key(domain, org, carol_app)
+    with _lock:
+        cache = _load_cache(cache_path)
+        old = cache['keys'].get(key)
+        if old is not None:
+            cache['stale'].append(dict(old, domain=domain, org=org, carol_app=carol_app))
+        cache['keys'][key] = new_entry
+        _save_cache(cache_path, cache)
+    _validated[key] = time.time()
+
+    login = _carol(domain, org, carol_app, ApiKeyAuth(new_entry['api_key']), connector_id=new_entry['connector_id'])
+    return login
+
+
+def revoke_stale_keys(cache_path=CACHE_PATH, n_jobs=8):
+    """
+    Revoke the API keys replaced by `get_login`.
+
+    Args:
+        cache_path: str
+            File with the cached API keys.
+        n_jobs: int
+            Number of keys revoked at the same time.
+
+    Returns: list
+        Keys that could not be revoked. They are kept to be tried again.
+
+    """
+    logger = logging.getLogger(__name__)
+
+    def revoke(entry):
+        try:
+            login = _carol(entry['domain'], entry['org'], entry['carol_app'], ApiKeyAuth(entry['api_key']),
+                           connector_id=entry['connector_id'])
+            login.api_key_revoke(entry['connector_id'])
+            return None
+        except CarolApiResponseException as e:
+            if error_code(e) == 401:
+                # Already expired or revoked.
+                return None
+            logger.warning(f"error revoking api key of {entry['domain']}", exc_info=1)
+            return entry
+        except Exception:
+            logger.warning(f"error revoking api key of {entry['domain']}", exc_info=1)
+            return entry
+
+    with _lock:
+        stale = _load_cache(cache_path)['stale']
+    if not stale:
+        return []
+
+    failed = Parallel(n_jobs=n_jobs, backend='threading')(delayed(revoke)(i) for i in stale)
+    failed = [i for i in failed if i is not None]
 
-    login = Carol(domain, carol_app, auth=ApiKeyAuth(api_key['X-Auth-Key']),
-                  connector_id=api_key['X-Auth-ConnectorId'], organization=org, )
-    return login
\ No newline at end of file
+    with _lock:
+        cache = _load_cache(cache_path)
+        revoked = [i['api_key'] for i in stale if i not in failed]
+        cache['stale'] = [i for i in cache['stale'] if i['api_key'] not in revoked]
+        _save_cache(cache_path, cache)
+    return failed
@@ -5,113 +5,378 @@ from pycarol import (
 from pycarol import CDSGolden
 from pycarol.query import delete_golden
 from collections import defaultdict
+import asyncio
 import random
+import threading
 import time
 import logging
 from joblib import Parallel, delayed
-from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pycarol.exceptions import CarolApiResponseException
+from .carol_errors import error_code
+from .sizing import default_sizing
+from . import admission as admission_control
 
 
-def cancel_tasks(login, task_list, logger=None):
+def cancel_tasks(login, task_list, logger=None, n_jobs=8):
+    """
+    Force cancel a list of tasks concurrently.
+
+    Args:
+        login: pycarol.Carol
+            Carol() instance.
+        task_list: list
+            List of task ids.
+        logger:
+            Logger to be used. If None will use
+                logger = logging.getLogger(login.domain)
+        n_jobs: int
+            Number of concurrent requests.
+
+    Returns: dict
+        task id -> {'success': bool, 'error': error message or None}
+
+    """
     if logger is None:
         logger = logging.getLogger(login.domain)
 
     carol_task = Tasks(login)
-    for i in task_list:
-        logger.debug(f"Canceling {i}")
-        carol_task.cancel(task_id=i, force=True)
 
-    return
+    def cancel(task_id):
+        logger.debug(f"Canceling {task_id}")
+        try:
+            carol_task.cancel(task_id=task_id, force=True)
+        except Exception as e:
+            # Usually the task finished in the meantime.
+            logger.warning(f"error canceling {task_id}: {e}")
+            return task_id, {'success': False, 'error': str(e)}
+        return task_id, {'success': True, 'error': None}
+
+    return dict(Parallel(n_jobs=n_jobs, backend='threading')(delayed(cancel)(i) for i in task_list))
+
+
+def get_tasks_status(login, task_list, page_size=1000):
+    """
+    Fetch the status of a list of tasks using filter queries.
+
+    Args:
+        login: pycarol.Carol
+            Carol() instance.
+        task_list: list
+            List of task ids.
+        page_size: int
+            Number of tasks per query.
+
+    Returns: dict
+        task id -> task status. Tasks not yet indexed are not returned.
+
+    """
+
+    uri = 'v1/queries/filter?indexType=MASTER&scrollable=false&pageSize={page_size}&offset=0'
+
+    status = {}
+    for i in range(0, len(task_list), page_size):
+        chunk = list(task_list[i:i + page_size])
+        query = {"mustList": [{"mdmFilterType": "TYPE_FILTER", "mdmValue": "mdmTask"},
+                              {"mdmKey": "mdmId", "mdmFilterType": "TERMS_FILTER",
+                               "mdmValue": chunk}]
+                 }
+        r = login.call_api(path=uri.format(page_size=len(chunk)), method='POST', data=query)['hits']
+        status.update({task['mdmId']: task['mdmTaskStatus'] for task in r})
+
+    return status
 
 
-def track_tasks(login, task_list, do_not_retry=False, logger=None, callback=None):
+def check_tasks(login, task_list, retry_tasks, max_retries, do_not_retry=False, logger=None, batch_status=True):
+    """
+    Single polling pass over a list of tasks, reprocessing the failed ones.
+
+    Args:
+        login: pycarol.Carol
+            Carol() instance.
+        task_list: list
+            List of task ids.
+        retry_tasks: defaultdict(int)
+            Number of retries per task. Updated in place.
+        max_retries: set
+            Tasks that reached the max number of retries. Updated in place.
+        do_not_retry: bool
+            Do not reprocess failed tasks.
+        logger:
+            Logger to be used. If None will use
+                logger = logging.getLogger(login.domain)
+        batch_status: bool
+            Fetch all status in a single filter query.
+
+    Returns: dict, bool, bool
+        task status -> list of tasks, finished, fail status.
+
+    """
     if logger is None:
         logger = logging.getLogger(login.domain)
 
-    retry_tasks = defaultdict(int)
     n_task = len(task_list)
-    max_retries = set()
+    task_status = defaultdict(list)
+    if batch_status:
+        status = get_tasks_status(login, task_list)
+    else:
+        status = {}
     carol_task = Tasks(login)
+    for task in task_list:
+        if task not in status:
+            # Not in the index yet (or batch disabled), fetch it directly.
+            status[task] = carol_task.get_task(task).task_status
+        task_status[status[task]].append(task)
+    for task in task_status['FAILED'] + task_status['CANCELED']:
+        logger.warning(f'Something went wrong while processing: {task}')
+        retry_tasks[task] += 1
+        if do_not_retry:
+            logger.error(f'Task: {task} failed. It wll not be restarted.')
+            continue
+        if retry_tasks[task] > 3:
+            max_retries.update([task])
+            logger.error(f'Task: {task} failed 3 times. will not restart')
+            continue
+
+        logger.info(f'Retry task: {task}')
+        login.call_api(path=f'v1/tasks/{task}/reprocess', method='POST')
+
+    if len(task_status['COMPLETED']) == n_task:
+        logger.debug(f'All task finished')
+        return task_status, True, False
+
+    elif len(max_retries) + len(task_status['COMPLETED']) == n_task:
+        logger.warning(f'There are {len(max_retries)} failed tasks.')
+        return task_status, True, True
+
+    return task_status, False, False
+
+
+def track_tasks(login, task_list, do_not_retry=False, logger=None, callback=None, batch_status=True):
+    if logger is None:
+        logger = logging.getLogger(login.domain)
+
+    retry_tasks = defaultdict(int)
+    max_retries = set()
     while True:
-        task_status = defaultdict(list)
-        for task in task_list:
-            status = carol_task.get_task(task).task_status
-            task_status[status].append(task)
-        for task in task_status['FAILED'] + task_status['CANCELED']:
-            logger.warning(f'Something went wrong while processing: {task}')
-            retry_tasks[task] += 1
-            if do_not_retry:
-                logger.error(f'Task: {task} failed. It wll not be restarted.')
-                continue
-            if retry_tasks[task] > 3:
-                max_retries.update([task])
-                logger.error(f'Task: {task} failed 3 times. will not restart')
-                continue
-
-            logger.info(f'Retry task: {task}')
-            login.call_api(path=f'v1/tasks/{task}/reprocess', method='POST')
-
-        if len(task_status['COMPLETED']) == n_task:
-            logger.debug(f'All task finished')
-            return task_status, False
-
-        elif len(max_retries) + len(task_status['COMPLETED']) == n_task:
-            logger.warning(f'There are {len(max_retries)} failed tasks.')
-            return task_status, True
-        else:
-            time.sleep(round(10 + random.random() * 5, 2))
-            logger.debug('Waiting for tasks')
+        task_status, finished, fail = check_tasks(login, task_list, retry_tasks, max_retries,
+                                                  do_not_retry=do_not_retry, logger=logger,
+                                                  batch_status=batch_status)
+        if finished:
+            return task_status, fail
+
+        time.sleep(round(10 + random.random() * 5, 2))
+        logger.debug('Waiting for tasks')
         if callable(callback):
             callback()
 
 
-def drop_staging(login, staging_list,connector_name, logger=None):
+class TaskWatcher:
     """
-    Drop a list of stagings
+    Watch a set of tasks, yielding `(task_id, old_status, new_status)` as their status change.
+
+    Failed/canceled tasks are reprocessed as in `track_tasks`: up to 3 times, or never if `do_not_retry`.
+    Tasks that will not be retried anymore are in `max_retries`. Tasks can be added with `add` while
+    iterating; if `keep_open`, iteration only ends after `close` is called and all tasks are finished.
+    `old_status` is None the first time a task is seen.
+
+    Iterating (`for event in watcher`) blocks between polls, `async for event in watcher` does not.
+
+    Args:
+        login: pycarol.Carol
+            Carol() instance.
+        task_list: list
+            Initial list of task ids.
+        do_not_retry: bool
+            Do not reprocess failed tasks.
+        logger:
+            Logger to be used. If None will use
+                logger = logging.getLogger(login.domain)
+        keep_open: bool
+            Keep watching when all tasks are finished, until `close` is called.
+        batch_status: bool
+            Fetch all status in a single filter query.
+
+    """
+
+    def __init__(self, login, task_list=(), do_not_retry=False, logger=None, keep_open=False, batch_status=True):
+        if logger is None:
+            logger = logging.getLogger(login.domain)
+        self.login = login
+        self.do_not_retry = do_not_retry
+        self.logger = logger
+        self.keep_open = keep_open
+        self.batch_status = batch_status
+        self.status = {}
+        self.retry_tasks = defaultdict(int)
+        self.max_retries = set()
+        self._lock = threading.Lock()
+        self.add(task_list)
+
+    def add(self, task_list):
+        with self._lock:
+            for task in task_list:
+                self.status.setdefault(task, None)
+
+    def close(self):
+        self.keep_open = False
+
+    def active(self):
+        with self._lock:
+            return [task for task, status in self.status.items()
+                    if status != 'COMPLETED' and task not in self.max_retries]
+
+    @property
+    def finished(self):
+        return not self.active()
+
+    @property
+    def done(self):
+        return self.finished and not self.keep_open
+
+    @property
+    def fail(self):
+        return bool(self.max_retries)
+
+    def task_status(self):
+        """
+        Returns: dict
+            task status -> list of tasks, as returned by `track_tasks`.
+        """
+        task_status = defaultdict(list)
+        with self._lock:
+            for task, status in self.status.items():
+                task_status[status].append(task)
+        return task_status
+
+    def poll(self):
+        """
+        Single polling pass.
+
+        Returns: list
+            (task_id, old_status, new_status) of the tasks whose status changed.
+        """
+        active = self.active()
+        if not active:
+            return []
+
+        task_status, _, _ = check_tasks(self.login, active, self.retry_tasks, self.max_retries,
+                                        do_not_retry=self.do_not_retry, logger=self.logger,
+                                        batch_status=self.batch_status)
+        if self.do_not_retry:
+            self.max_retries.update(task_status['FAILED'] + task_status['CANCELED'])
+
+        events = []
+        with self._lock:
+            for status, tasks in task_status.items():
+                for task in tasks:
+                    if self.status[task] != status:
+                        events.append((task, self.status[task], status))
+                        self.status[task] = status
+        return events
+
+    def __iter__(self):
+        while True:
+            yield from self.poll()
+            if self.done:
+                return
+            time.sleep(round(10 + random.random() * 5, 2))
+
+    async def __aiter__(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            for event in await loop.run_in_executor(None, self.poll):
+                yield event
+            if self.done:
+                return
+            await asyncio.sleep(round(10 + random.random() * 5, 2))
+
+
+def par_drop_staging(login, staging_list, connector_name, n_jobs=8, logger=None, metadata=None):
+    """
+    Drop a list of stagings concurrently.
+
+    A staging already dropped (`SCHEMA_NOT_FOUND`) counts as success.
 
     Args:
         login: pycarol.Carol
             Carol() instance.
         staging_list: list
             List of stagings to drop
+        connector_name: str
+            Connector Name
+        n_jobs: int
+            Number of concurrent requests.
         logger:
             Logger to be used. If None will use
                 logger = logging.getLogger(login.domain)
+        metadata: metadata.TenantMetadata
+            Tenant metadata, its stagings are invalidated.
 
-    Returns: list, status
-        List of tasks created, fail status.
+    Returns: dict
+        staging -> {'success': bool, 'error': error message or None, 'task_id': task created or None}
 
     """
-
     if logger is None:
         logger = logging.getLogger(login.domain)
+    if metadata is not None:
+        metadata.invalidate('stagings', 'entity_mappings')
 
-    tasks = []
-    for i in staging_list:
-        stag = Staging(login)
+    stag = Staging(login)
 
+    def drop(staging_name):
         try:
-            r = stag.drop_staging(staging_name=i, connector_name=connector_name, )
-            tasks += [r['taskId']]
-            logger.debug(f"dropping {i} - {r['taskId']}")
-
+            r = stag.drop_staging(staging_name=staging_name, connector_name=connector_name, )
         except CarolApiResponseException as e:
             if 'SCHEMA_NOT_FOUND' in str(e):
-                logger.debug(f"{i} a;ready dropped.")
-                continue
-            else:
-                logger.error("error dropping staging", exc_info=1)
-                return tasks, True
-
+                logger.debug(f"{staging_name} already dropped.")
+                return staging_name, {'success': True, 'error': None, 'task_id': None}
+            logger.error(f"error dropping staging {staging_name}", exc_info=1)
+            return staging_name, {'success': False, 'error': str(e), 'task_id': None}
         except Exception as e:
-            logger.error("error dropping staging", exc_info=1)
-            return tasks, True
+            logger.error(f"error dropping staging {staging_name}", exc_info=1)
+            return staging_name, {'success': False, 'error': str(e), 'task_id': None}
+
+        logger.debug(f"dropping {staging_name} - {r['taskId']}")
+        return staging_name, {'success': True, 'error': None, 'task_id': r['taskId']}
+
+    return dict(Parallel(n_jobs=n_jobs, backend='threading')(delayed(drop)(i) for i in staging_list))
+
+
+def drop_staging(login, staging_list,connector_name, logger=None, metadata=None, n_jobs=8):
+    """
+    Drop a list of stagings
+
+    Args:
+        login: pycarol.Carol
+            Carol() instance.
+        staging_list: list
+            List of stagings to drop
+        logger:
+            Logger to be used. If None will use
+                logger = logging.getLogger(login.domain)
+        metadata: metadata.TenantMetadata
+            Tenant metadata, its stagings are invalidated.
+        n_jobs: int
+            Number of concurrent requests.
 
-    return tasks, False
+    Returns: list, status
+        List of tasks created, fail status.
 
+    """
 
-def get_all_stagings(login, connector_name):
+    if logger is None:
+        logger = logging.getLogger(login.domain)
+
+    r = par_drop_staging(login, staging_list, connector_name, n_jobs=n_jobs, logger=logger, metadata=metadata)
+    tasks = [i['task_id'] for i in r.values() if i['task_id'] is not None]
+    failed = {staging_name: i['error'] for staging_name, i in r.items() if not i['success']}
+    if failed:
+        logger.error(f"error dropping stagings {failed}")
+    return tasks, bool(failed)
+
+
+def get_all_stagings(login, connector_name, metadata=None):
     """
     Get all staging tables from a connector.
 
@@ -120,18 +385,22 @@ def get_all_stagings(login, connector_name):
             Carol() instance.
         connector_name: str
             Connector Name
+        metadata: metadata.TenantMetadata
+            If given, the cached stagings are used.
 
     Returns: list
         list of staging for the connector.
 
     """
+    if metadata is not None:
+        return metadata.stagings(connector_name)
 
     conn_stats = Connectors(login).stats(connector_name=connector_name)
     st = [i for i in list(conn_stats.values())[0]]
     return sorted(st)
 
 
-def get_all_etls(login, connector_name):
+def get_all_etls(login, connector_name, metadata=None):
     """
     get all ETLs from a connector.
 
@@ -140,122 +409,458 @@ def get_all_etls(login, connector_name):
             Carol() instance.
         connector_name: str
             Connector Name
+        metadata: metadata.TenantMetadata
+            If given, the cached connector id is used.
 
     Returns: list
         list of ETLs
 
     """
 
-    connector_id = Connectors(login).get_by_name(connector_name)['mdmId']
+    if metadata is not None:
+        connector_id = metadata.connector_id(connector_name)
+    else:
+        connector_id = Connectors(login).get_by_name(connector_name)['mdmId']
     etls = login.call_api(f'v1/etl/connector/{connector_id}', method='GET')
     return etls
 
 
-def drop_etls(login, etl_list):
+def get_last_updated(login, staging_name, connector_id):
+    """
+    Latest `mdmLastUpdated` of the records of a staging, None if it could not be fetched.
+    """
+    uri = 'v1/queries/filter?indexType=STAGING&scrollable=false&pageSize=1&offset=0&sortBy=mdmLastUpdated&sortOrder=DESC'
+    query = {"mustList": [{"mdmFilterType": "TYPE_FILTER", "mdmValue": f"{connector_id}_{staging_name}"}]}
+    try:
+        r = login.call_api(path=uri, method='POST', data=query)['hits']
+    except Exception:
+        logging.getLogger(login.domain).debug(f"error fetching last update of {staging_name}", exc_info=1)
+        return None
+    return str(r[0].get('mdmLastUpdated')) if r else None
+
+
+def get_watermarks(login, connector_name, staging_list, n_jobs=8, metadata=None):
+    """
+    Number of records and latest update of a list of stagings, fetched concurrently.
+
+    Args:
+        login: pycarol.Carol
+            Carol() instance.
+        connector_name: str
+            Connector Name
+        staging_list: list
+            List of stagings.
+        n_jobs: int
+            Number of concurrent stagings.
+        metadata: metadata.TenantMetadata
+            If given, the cached connector id is used.
+
+    Returns: dict
+        staging -> {'n_records': int, 'last_updated': str or None}
+
+    """
+    if metadata is not None:
+        connector_id = metadata.connector_id(connector_name)
+    else:
+        connector_id = Connectors(login).get_by_name(connector_name)['mdmId']
+
+    def watermark(staging_name):
+        n_records = CDSStaging(login).count(staging_name=staging_name, connector_name=connector_name)
+        return staging_name, {'n_records': n_records,
+                              'last_updated': get_last_updated(login, staging_name, connector_id)}
+
+    return dict(Parallel(n_jobs=n_jobs, backend='threading')(delayed(watermark)(i) for i in staging_list))
+
+
+def changed_stagings(old, new):
+    """
+    Stagings whose watermark changed, or that have no previous watermark.
+
+    Args:
+        old: dict
+            Previous watermarks, from `Journal.get_watermarks`.
+        new: dict
+            Current watermarks, from `get_watermarks`.
+
+    Returns: list
+
+    """
+    changed = []
+    for staging, mark in new.items():
+        previous = old.get(staging)
+        if previous is None or previous['n_records'] != mark['n_records']:
+            changed.append(staging)
+        elif None not in (previous['last_updated'], mark['last_updated']) and \
+                previous['last_updated'] != mark['last_updated']:
+            changed.append(staging)
+    return changed
+
+
+def _is_not_found(e):
+    return error_code(e) == 404
+
+
+def par_drop_etls(login, etl_list, n_jobs=8, logger=None, metadata=None):
     """
+    Delete a list of ETLs (draft and production) concurrently.
+
+    An ETL already deleted counts as success.
 
     Args:
         login: login: pycarol.Carol
             Carol() instance.
         etl_list: list
             list of ETLs to delete.
+        n_jobs: int
+            Number of concurrent requests.
+        logger:
+            Logger to be used. If None will use
+                logger = logging.getLogger(login.domain)
+        metadata: metadata.TenantMetadata
+            Tenant metadata, its ETLs are invalidated.
 
-    Returns: None
+    Returns: dict
+        ETL id -> {'success': bool, 'error': error message or None}
 
     """
-    for i in etl_list:
-        mdm_id = i['mdmId']
+    if logger is None:
+        logger = logging.getLogger(login.domain)
+    if metadata is not None:
+        metadata.invalidate('etls')
+
+    def drop(mdm_id):
         try:
             # Delete drafts.
             login.call_api(f'v2/etl/{mdm_id}', method='DELETE', params={'entitySpace': 'WORKING'})
         except Exception as e:
-            pass
-        login.call_api(f'v2/etl/{mdm_id}', method='DELETE', params={'entitySpace': 'PRODUCTION'})
+            if not _is_not_found(e):
+                logger.debug(f"error deleting ETL draft {mdm_id}: {e}")
+        try:
+            login.call_api(f'v2/etl/{mdm_id}', method='DELETE', params={'entitySpace': 'PRODUCTION'})
+        except Exception as e:
+            if _is_not_found(e):
+                return mdm_id, {'success': True, 'error': None}
+            logger.error(f"error deleting ETL {mdm_id}", exc_info=1)
+            return mdm_id, {'success': False, 'error': str(e)}
+        return mdm_id, {'success': True, 'error': None}
+
+    return dict(Parallel(n_jobs=n_jobs, backend='threading')(delayed(drop)(i['mdmId']) for i in etl_list))
+
+
+def drop_etls(login, etl_list, metadata=None, n_jobs=8):
+    """
+
+    Args:
+        login: login: pycarol.Carol
+            Carol() instance.
+        etl_list: list
+            list of ETLs to delete.
+        metadata: metadata.TenantMetadata
+            Tenant metadata, its ETLs are invalidated.
+        n_jobs: int
+            Number of concurrent requests.
+
+    Returns: dict
+        ETL id -> {'success': bool, 'error': error message or None}
+
+    """
+    r = par_drop_etls(login, etl_list, n_jobs=n_jobs, metadata=metadata)
+    failed = {i: j['error'] for i, j in r.items() if not j['success']}
+    if failed:
+        raise ValueError(f'Some ETLs were not deleted. {failed}')
+    return r
+
+
+def get_sizing(login, staging_name, connector_name, task_type, sizing=None):
+    """
+    Resources for a consolidate/process task.
+
+    Args:
+        login: pycarol.Carol
+            Carol() instance.
+        staging_name: str
+            Staging name.
+        connector_name: str
+            Connector Name
+        task_type: str
+            `consolidate` or `process`.
+        sizing: sizing.SizingHistory
+            History used to choose the resources. If None, uses `sizing.default_sizing`.
+
+    Returns: int, dict
+        Number of records, resources (worker_type, number_shards and max_number_workers).
+
+    """
+    n_r = CDSStaging(login).count(staging_name=staging_name, connector_name=connector_name)
+    if sizing is None:
+        return n_r, default_sizing(n_r)
+    return n_r, sizing.choose(task_type, n_r)
 
 
 def par_processing(login, staging_name, connector_name, delete_realtime_records=False,
-                   delete_target_folder=False):
+                   delete_target_folder=False, sizing=None):
     cds_stag = CDSStaging(login)
-    n_r = cds_stag.count(staging_name=staging_name, connector_name=connector_name)
-    if n_r > 5000000:
-        worker_type = 'n1-highmem-16'
-        max_number_workers = 16
-    else:
-        worker_type = 'n1-highmem-4'
-        max_number_workers = 16
-    number_shards = round(n_r / 100000) + 1
-    number_shards = max(16, number_shards)
-    task_id = cds_stag.process_data(staging_name=staging_name, connector_name=connector_name, worker_type=worker_type,
-                                    number_shards=number_shards, max_number_workers=max_number_workers,
+    n_r, resources = get_sizing(login, staging_name, connector_name, 'process', sizing=sizing)
+    task_id = cds_stag.process_data(staging_name=staging_name, connector_name=connector_name,
                                     delete_target_folder=delete_target_folder, send_realtime=None,
-                                    delete_realtime_records=delete_realtime_records)
+                                    delete_realtime_records=delete_realtime_records, **resources)
+    if sizing is not None:
+        sizing.start(task_id['data']['mdmId'], 'process', n_r, resources, tenant=login.domain, staging=staging_name)
     return task_id
 
 
-def pause_and_clear_subscriptions(login, dm_list, logger):
+def bulk_subscriptions(login, dm_list, actions, n_jobs=8, logger=None):
+    """
+    Run subscription actions for all subscriptions of a list of DMs.
+
+    Subscriptions of all DMs are fetched concurrently, then `actions` are run, in order, for each
+    subscription on a thread pool. A failure does not stop the other subscriptions.
+
+    Args:
+        login: pycarol.Carol
+            Carol() instance.
+        dm_list: list
+            List of DM names.
+        actions: list
+            `Subscription` methods to call for each subscription, e.g. ['pause', 'clear'].
+        n_jobs: int
+            Number of concurrent requests.
+        logger:
+            Logger to be used. If None will use
+                logger = logging.getLogger(login.domain)
+
+    Returns: dict
+        subscription id (or DM name if its subscriptions could not be fetched) ->
+            {'name': DM name, 'success': bool, 'error': error message or None}
+
+    """
     if logger is None:
         logger = logging.getLogger(login.domain)
 
     subs = Subscription(login)
 
-    for idx in dm_list:
-        a = subs.get_dm_subscription(idx)
-
-        for dm in a:
-            logger.debug(f"Stopping {dm['mdmEntityTemplateName']}")
-            subs.pause(dm['mdmId'])
-            subs.clear(dm['mdmId'])
+    def fetch(dm_name):
+        try:
+            return dm_name, subs.get_dm_subscription(dm_name), None
+        except Exception as e:
+            logger.error(f"error fetching subscriptions of {dm_name}", exc_info=1)
+            return dm_name, [], str(e)
+
+    def run_actions(sub):
+        for action in actions:
+            logger.debug(f"{action} {sub['mdmEntityTemplateName']}")
+            try:
+                getattr(subs, action)(sub['mdmId'])
+            except Exception as e:
+                logger.error(f"error in {action} {sub['mdmEntityTemplateName']}", exc_info=1)
+                return sub['mdmId'], {'name': sub['mdmEntityTemplateName'], 'success': False,
+                                      'error': f'{action}: {e}'}
+        return sub['mdmId'], {'name': sub['mdmEntityTemplateName'], 'success': True, 'error': None}
+
+    results = {}
+    to_run = []
+    for dm_name, dm_subs, error in Parallel(n_jobs=n_jobs, backend='threading')(delayed(fetch)(i) for i in dm_list):
+        if error is not None:
+            results[dm_name] = {'name': dm_name, 'success': False, 'error': error}
+        to_run += dm_subs
+
+    results.update(Parallel(n_jobs=n_jobs, backend='threading')(delayed(run_actions)(i) for i in to_run))
+    return results
+
+
+def _check_subscriptions(results, logger):
+    failed = {i: r for i, r in results.items() if not r['success']}
+    if failed:
+        logger.error(f'Some subscriptions failed. {failed}')
+        raise ValueError(f'Some subscriptions failed. {failed}')
+    return results
+
+
+def pause_and_clear_subscriptions(login, dm_list, logger, n_jobs=8):
+    if logger is None:
+        logger = logging.getLogger(login.domain)
 
-    return
+    results = bulk_subscriptions(login, dm_list, ['pause', 'clear'], n_jobs=n_jobs, logger=logger)
+    return _check_subscriptions(results, logger)
 
 
-def play_subscriptions(login, dm_list, logger):
+def play_subscriptions(login, dm_list, logger, n_jobs=8):
     if logger is None:
         logger = logging.getLogger(login.domain)
 
-    subs = Subscription(login)
+    results = bulk_subscriptions(login, dm_list, ['play'], n_jobs=n_jobs, logger=logger)
+    return _check_subscriptions(results, logger)
 
-    for idx in dm_list:
-        a = subs.get_dm_subscription(idx)
 
-        for dm in a:
-            logger.debug(f"Playing {dm['mdmEntityTemplateName']}")
-            subs.play(dm['mdmId'])
+def find_task_types(login, task_type=("PROCESS_CDS_STAGING_DATA", "REPROCESS_SEARCH_RESULT"),
+                    task_status=("READY", "RUNNING"), page_size=1000):
+    """
+    Find all tasks of the given types and status, scrolling through all the pages.
 
-    return
+    Args:
+        login: pycarol.Carol
+            Carol() instance.
+        task_type: iterable
+            Task types.
+        task_status: iterable
+            Task status.
+        page_size: int
+            Number of tasks per page.
 
+    Returns: list
+        Tasks found.
 
-def find_task_types(login):
+    """
     # TODO can user Query from pycarol
-    uri = 'v1/queries/filter?indexType=MASTER&scrollable=false&pageSize=1000&offset=0&sortBy=mdmLastUpdated&sortOrder=DESC'
-
-    task_type = ["PROCESS_CDS_STAGING_DATA", "REPROCESS_SEARCH_RESULT"]
-    task_status = ["READY", "RUNNING"]
+    uri = 'v1/queries/filter?indexType=MASTER&scrollable=true&pageSize={page_size}&sortBy=mdmLastUpdated&sortOrder=DESC'
+    scroll_uri = 'v1/queries/filter/{scroll_id}?indexType=MASTER&scrollable=true&pageSize={page_size}'
 
     query = {"mustList": [{"mdmFilterType": "TYPE_FILTER", "mdmValue": "mdmTask"},
                           {"mdmKey": "mdmTaskType.raw", "mdmFilterType": "TERMS_FILTER",
-                           "mdmValue": task_type},
+                           "mdmValue": list(task_type)},
                           {"mdmKey": "mdmTaskStatus.raw", "mdmFilterType": "TERMS_FILTER",
-                           "mdmValue": task_status}]
+                           "mdmValue": list(task_status)}]
              }
 
-    r = login.call_api(path=uri, method='POST', data=query)['hits']
-    return r
+    tasks = []
+    r = login.call_api(path=uri.format(page_size=page_size), method='POST', data=query)
+    while True:
+        tasks += r['hits']
+        scroll_id = r.get('scrollId')
+        if scroll_id is None or len(r['hits']) < page_size:
+            break
+        r = login.call_api(path=scroll_uri.format(scroll_id=scroll_id, page_size=page_size), method='POST',
+                           data=query)
+    return tasks
+
 
+def par_pause_etls(login, etl_list, connector_name, n_jobs=8, logger=None, metadata=None):
+    """
+    Pause the ETLs of a list of stagings concurrently.
 
-def pause_etls(login, etl_list, connector_name, logger):
+    Args:
+        login: pycarol.Carol
+            Carol() instance.
+        etl_list: list
+            List of stagings whose ETLs will be paused.
+        connector_name: str
+            Connector Name
+        n_jobs: int
+            Number of concurrent requests.
+        logger:
+            Logger to be used. If None will use
+                logger = logging.getLogger(login.domain)
+        metadata: metadata.TenantMetadata
+            If given, the cached connector id is used.
+
+    Returns: dict
+        staging -> {'success': bool, 'error': error message or None, 'response': Carol response}
+
+    """
     if logger is None:
         logger = logging.getLogger(login.domain)
 
-    r = {}
     conn = Connectors(login)
-    for staging_name in etl_list:
+    if metadata is not None:
+        connector = {'connector_id': metadata.connector_id(connector_name)}
+    else:
+        connector = {'connector_name': connector_name}
+
+    def pause(staging_name):
         logger.debug(f'Pausing {staging_name} ETLs')
-        r[staging_name] = conn.pause_etl(connector_name=connector_name, staging_name=staging_name)
+        try:
+            resp = conn.pause_etl(staging_name=staging_name, **connector)
+        except Exception as e:
+            logger.error(f'Error pausing {staging_name} ETLs', exc_info=1)
+            return staging_name, {'success': False, 'error': str(e), 'response': None}
+        return staging_name, {'success': resp['success'], 'error': None if resp['success'] else str(resp),
+                              'response': resp}
+
+    return dict(Parallel(n_jobs=n_jobs, backend='threading')(delayed(pause)(i) for i in etl_list))
+
+
+def pause_etls(login, etl_list, connector_name, logger, metadata=None, n_jobs=8):
+    if logger is None:
+        logger = logging.getLogger(login.domain)
+
+    r = par_pause_etls(login, etl_list, connector_name, n_jobs=n_jobs, logger=logger, metadata=metadata)
 
     if not all(i['success'] for _, i in r.items()):
         logger.error(f'Some ETLs were not paused. {r}')
         raise ValueError(f'Some ETLs were not paused. {r}')
+    return r
+
+
+def get_etl_states(login, connector_name, metadata=None):
+    """
+    Running state of the ETLs of a connector.
+
+    Args:
+        login: pycarol.Carol
+            Carol() instance.
+        connector_name: str
+            Connector Name
+        metadata: metadata.TenantMetadata
+            If given, the cached connector id is used.
+
+    Returns: dict
+        source staging -> list of running states of its ETLs.
+
+    """
+    states = defaultdict(list)
+    for etl in get_all_etls(login, connector_name=connector_name, metadata=metadata):
+        if 'mdmRunningState' in etl:
+            states[etl['mdmSourceEntityName']].append(etl['mdmRunningState'])
+    return states
+
+
+def get_mapping_states(login, connector_name):
+    """
+    Running state of the mappings of a connector.
+
+    Args:
+        login: pycarol.Carol
+            Carol() instance.
+        connector_name: str
+            Connector Name
+
+    Returns: dict, dict
+        staging -> list of running states, DM -> list of running states.
+
+    """
+    by_staging = defaultdict(list)
+    by_dm = defaultdict(list)
+    for mapping in Connectors(login).get_dm_mappings(connector_name=connector_name, ):
+        by_staging[mapping.get('mdmStagingType')].append(mapping['mdmRunningState'])
+        by_dm[mapping['mdmMasterEntityName']].append(mapping['mdmRunningState'])
+    return by_staging, by_dm
+
+
+def is_paused(login, connector_name, staging_list, dm_list, metadata=None):
+    """
+    Check if the ETLs of `staging_list` and the mappings of `dm_list` are not running.
+
+    Returns: bool
+
+    """
+    etls = get_etl_states(login, connector_name, metadata=metadata)
+    _, mappings = get_mapping_states(login, connector_name)
+    running = [i for i in staging_list if 'RUNNING' in etls.get(i, [])]
+    running += [i for i in dm_list if 'RUNNING' in mappings.get(i, [])]
+    return not running
+
+
+def get_playing(login, connector_name, staging_list, metadata=None):
+    """
+    Stagings from `staging_list` whose ETLs and mappings are all running.
+
+    Returns: list
+
+    """
+    etls = get_etl_states(login, connector_name, metadata=metadata)
+    mappings, _ = get_mapping_states(login, connector_name)
+    return [i for i in staging_list
+            if all(state == 'RUNNING' for state in etls.get(i, []) + mappings.get(i, []))]
 
 
 def pause_dms(login, dm_list, connector_name):
@@ -267,31 +872,54 @@ def pause_dms(login, dm_list, connector_name):
     r = conn.pause_mapping(connector_name=connector_name, entity_mapping_id=mappings)
 
 
-def par_consolidate(login, staging_name, connector_name, compute_transformations=False):
+def par_consolidate(login, staging_name, connector_name, compute_transformations=False, sizing=None,
+                    admission=None, sized=None):
+    """
+    Create the consolidate task of a staging.
+
+    If `admission` is given, the task is only created once admitted, without waiting: None is returned
+    while there is no slot for it, the caller should try again later.
+
+    Args:
+        sized: tuple
+            Number of records and resources, from `get_sizing`. Computed if None.
+    """
     cds_stag = CDSStaging(login)
-    n_r = cds_stag.count(staging_name=staging_name, connector_name=connector_name)
-    if n_r > 5000000:
-        worker_type = 'n1-highmem-16'
-        max_number_workers = 16
+    if sized is None:
+        sized = get_sizing(login, staging_name, connector_name, 'consolidate', sizing=sizing)
+    n_r, resources = sized
+    if admission is not None:
+        key = f'{login.domain}/{staging_name}/consolidate'
+        if not admission.try_acquire(key, admission_control.get_weight(n_r), tenant=login.domain):
+            return None
+        try:
+            task_id = cds_stag.consolidate(staging_name=staging_name, connector_name=connector_name,
+                                           compute_transformations=compute_transformations, rehash_ids=True,
+                                           **resources)
+        except Exception:
+            admission.release(key)
+            raise
+        admission.attach(key, task_id['data']['mdmId'])
     else:
-        worker_type = 'n1-highmem-4'
-        max_number_workers = 16
-    number_shards = round(n_r / 100000) + 1
-    number_shards = max(16, number_shards)
-    task_id = cds_stag.consolidate(staging_name=staging_name, connector_name=connector_name, worker_type=worker_type,
-                                   compute_transformations=compute_transformations,
-                                   number_shards=number_shards, rehash_ids=True, max_number_workers=max_number_workers)
+        task_id = cds_stag.consolidate(staging_name=staging_name, connector_name=connector_name,
+                                       compute_transformations=compute_transformations, rehash_ids=True,
+                                       **resources)
+    if sizing is not None:
+        sizing.start(task_id['data']['mdmId'], 'consolidate', n_r, resources, tenant=login.domain,
+                     staging=staging_name)
     return task_id
 
 
-def consolidate_stagings(login, connector_name, staging_list, n_jobs=5, compute_transformations=False, logger=None):
+def consolidate_stagings(login, connector_name, staging_list, n_jobs=5, compute_transformations=False, logger=None,
+                         sizing=None):
     if logger is None:
         logger = logging.getLogger(login.domain)
 
     task_id = Parallel(n_jobs=n_jobs, backend='threading')(delayed(par_consolidate)(
         login, staging_name=i,
         connector_name=connector_name,
-        compute_transformations=compute_transformations
+        compute_transformations=compute_transformations,
+        sizing=sizing,
     )
                                                            for i in staging_list)
 
@@ -300,44 +928,109 @@ def consolidate_stagings(login, connector_name, staging_list, n_jobs=5, compute_
     return task_list
 
 
-def par_delete_golden(login, dm_list, n_jobs=5):
-    tasks = []
+def _stream(executor, jobs):
+    """
+    Run `jobs` on `executor` and yield their results as they finish.
+
+    A job may return a list of new jobs to run, instead of a result.
+    """
+    pending = {executor.submit(*job) for job in jobs}
+    while pending:
+        finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in finished:
+            r = future.result()
+            if isinstance(r, list):
+                pending.update(executor.submit(*job) for job in r)
+            elif r is not None:
+                yield r
+
+
+def iter_delete_golden(login, dm_list, n_jobs=8, metadata=None):
+    """
+    Delete golden and rejected records of a list of DMs, yielding task ids as they are created.
+
+    For each DM the rejected clearData, the CDS golden delete and the (blocking) golden delete query
+    run as separate jobs on a thread pool, so the query overlaps with the other submissions.
+
+    Args:
+        login: pycarol.Carol
+            Carol() instance.
+        dm_list: list
+            List of DM names.
+        n_jobs: int
+            Number of threads.
+        metadata: metadata.TenantMetadata
+            If given, the cached DM ids are used.
+
+    Returns: generator
+        Task ids.
+
+    """
+
+    def clear_rejected(dm_id):
+        return login.call_api("v2/cds/rejected/clearData", method='POST',
+                              params={'entityTemplateId': dm_id})['taskId']
 
-    def del_golden(dm_name, login):
-        t = []
-        dm_id = DataModel(login).get_by_name(dm_name)['mdmId']
-        task = login.call_api("v2/cds/rejected/clearData", method='POST', params={'entityTemplateId': dm_id})['taskId']
-        t += [task]
-        cds_CDSGolden = CDSGolden(login)
-        task = cds_CDSGolden.delete(dm_id=dm_id, )
+    def delete_cds(dm_id):
+        return CDSGolden(login).delete(dm_id=dm_id, )['taskId']
+
+    def delete_golden_query(dm_name):
         delete_golden(login, dm_name)
-        t += [task['taskId'], ]
-        return t
 
-    tasks = Parallel(n_jobs=n_jobs)(delayed(del_golden)(i, login) for i in dm_list)
-    return list(chain(*tasks))
+    def del_golden(dm_name):
+        if metadata is not None:
+            dm_id = metadata.dm_id(dm_name)
+        else:
+            dm_id = DataModel(login).get_by_name(dm_name)['mdmId']
+        return [(clear_rejected, dm_id), (delete_cds, dm_id), (delete_golden_query, dm_name)]
 
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        yield from _stream(executor, [(del_golden, i) for i in dm_list])
 
-def par_delete_staging(login, staging_list, connector_name, n_jobs=5):
-    tasks = []
 
-    def del_staging(staging_name, connector_name, login):
-        t = []
-        cds_ = CDSStaging(login)
-        task = cds_.delete(staging_name=staging_name, connector_name=connector_name)
-        t += [task['taskId'], ]
-        return t
+def iter_delete_staging(login, staging_list, connector_name, n_jobs=8):
+    """
+    Delete the CDS data of a list of stagings, yielding task ids as they are created.
+
+    Args:
+        login: pycarol.Carol
+            Carol() instance.
+        staging_list: list
+            List of stagings.
+        connector_name: str
+            Connector Name
+        n_jobs: int
+            Number of threads.
+
+    Returns: generator
+        Task ids.
+
+    """
+
+    def del_staging(staging_name):
+        return CDSStaging(login).delete(staging_name=staging_name, connector_name=connector_name)['taskId']
 
-    tasks = Parallel(n_jobs=n_jobs)(delayed(del_staging)(i, connector_name, login) for i in staging_list)
-    return list(chain(*tasks))
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        yield from _stream(executor, [(del_staging, i) for i in staging_list])
 
 
-def resume_process(login, connector_name, staging_name, logger=None, delay=1):
+def par_delete_golden(login, dm_list, n_jobs=8, metadata=None):
+    return list(iter_delete_golden(login, dm_list, n_jobs=n_jobs, metadata=metadata))
+
+
+def par_delete_staging(login, staging_list, connector_name, n_jobs=8):
+    return list(iter_delete_staging(login, staging_list, connector_name, n_jobs=n_jobs))
+
+
+def resume_process(login, connector_name, staging_name, logger=None, delay=1, metadata=None):
     if logger is None:
         logger = logging.getLogger(login.domain)
 
     conn = Connectors(login)
-    connector_id = conn.get_by_name(connector_name)['mdmId']
+    if metadata is not None:
+        connector_id = metadata.connector_id(connector_name)
+    else:
+        connector_id = conn.get_by_name(connector_name)['mdmId']
 
     # TODO Review this once we have mapping and ETLs in the same staging.
     # Play ETLs if any.
@@ -347,7 +1040,10 @@ def resume_process(login, connector_name, staging_name, logger=None, delay=1):
         raise ValueError(f'Problem starting ETL {connector_name}/{staging_name}\n {resp}')
 
     # Play mapping if any.
-    mappings_ = check_mapping(login, connector_name, staging_name, )
+    if metadata is not None:
+        mappings_ = metadata.entity_mappings(connector_name, staging_name)
+    else:
+        mappings_ = check_mapping(login, connector_name, staging_name, )
     if mappings_ is not None:
         # TODO: here assuming only one mapping per staging.
         mappings_ = mappings_[0]
@@ -359,6 +1055,46 @@ def resume_process(login, connector_name, staging_name, logger=None, delay=1):
     return mappings_
 
 
+def par_resume_process(login, connector_name, staging_list, n_jobs=8, logger=None, metadata=None):
+    """
+    Run `resume_process` for a list of stagings concurrently.
+
+    Args:
+        login: pycarol.Carol
+            Carol() instance.
+        connector_name: str
+            Connector Name
+        staging_list: list
+            Stagings to play.
+        n_jobs: int
+            Number of concurrent stagings.
+        logger:
+            Logger to be used. If None will use
+                logger = logging.getLogger(login.domain)
+        metadata: metadata.TenantMetadata
+            If given, the cached connector id and mappings are used.
+
+    Returns: dict
+        staging -> {'success': bool, 'error': error message or None, 'mapping': mapping played or None}
+
+    """
+    if logger is None:
+        logger = logging.getLogger(login.domain)
+    if metadata is not None:
+        # Resolve it once instead of once per thread.
+        metadata.connector_id(connector_name)
+
+    def resume(staging_name):
+        try:
+            mapping = resume_process(login, connector_name=connector_name, staging_name=staging_name,
+                                     logger=logger, delay=0, metadata=metadata)
+        except Exception as e:
+            return staging_name, {'success': False, 'error': str(e), 'mapping': None}
+        return staging_name, {'success': True, 'error': None, 'mapping': mapping}
+
+    return dict(Parallel(n_jobs=n_jobs, backend='threading')(delayed(resume)(i) for i in staging_list))
+
+
 def check_mapping(login, connector_name, staging_name, logger=None):
     if logger is None:
         logger = logging.getLogger(login.domain)
@@ -383,3 +1119,42 @@ def cancel_task_subprocess(login):
     pross_task = [i['mdmId'] for i in pross_tasks]
     if pross_task:
         cancel_tasks(login, pross_task)
+
+
+class TaskCanceller:
+    """
+    `track_tasks` callback cancelling the processing tasks created while an app is installing.
+
+    Runs at most once every `min_interval` seconds and does not cancel again the tasks it already
+    cancelled.
+
+    Args:
+        login: pycarol.Carol
+            Carol() instance.
+        min_interval: float
+            Min seconds between two runs.
+        logger:
+            Logger to be used. If None will use
+                logger = logging.getLogger(login.domain)
+
+    """
+
+    def __init__(self, login, min_interval=60, logger=None):
+        if logger is None:
+            logger = logging.getLogger(login.domain)
+        self.login = login
+        self.min_interval = min_interval
+        self.logger = logger
+        self.cancelled = set()
+        self._last = None
+
+    def __call__(self):
+        now = time.time()
+        if self._last is not None and now - self._last < self.min_interval:
+            return
+        self._last = now
+
+        pross_task = [i['mdmId'] for i in find_task_types(self.login) if i['mdmId'] not in self.cancelled]
+        if pross_task:
+            r = cancel_tasks(self.login, pross_task, logger=self.logger)
+            self.cancelled.update(task for task, result in r.items() if result['success'])
@@ -1,109 +1,510 @@
-from toposort import toposort_flatten, toposort
+from toposort import toposort_flatten, toposort, CircularDependencyError
 from . import carol_task
+from . import admission as admission_control
+from .sizing import WORKER_TYPES, default_sizing
 from pycarol import CDSStaging, Connectors
-from functools import reduce
+from functools import partial, reduce, lru_cache
+import json
 import logging
+import os
+import random
 import time
+from collections import defaultdict
+
+PIPELINE_PATH = os.environ.get('TECHFIN_PIPELINE', os.path.join(os.path.dirname(__file__), 'pipeline.json'))
+
+RESOURCES = ('worker_type', 'number_shards', 'max_number_workers')
+NODE_KEYS = {'depends_on', 'recursive_processing', 'priority', *RESOURCES}
+
+
+class PipelineError(ValueError):
+    pass
+
+
+def _check_node(node, spec):
+    unknown = set(spec) - NODE_KEYS
+    if unknown:
+        raise PipelineError(f"{node}: unknown keys {sorted(unknown)}")
+    if not isinstance(spec.get('depends_on', []), list):
+        raise PipelineError(f"{node}: depends_on must be a list")
+    if spec.get('worker_type') is not None and spec['worker_type'] not in WORKER_TYPES:
+        raise PipelineError(f"{node}: unknown worker_type {spec['worker_type']}")
+    for key in ('number_shards', 'max_number_workers'):
+        value = spec.get(key)
+        if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 1):
+            raise PipelineError(f"{node}: {key} must be a positive integer")
+    if not isinstance(spec.get('recursive_processing', False), bool):
+        raise PipelineError(f"{node}: recursive_processing must be a boolean")
+    if not isinstance(spec.get('priority', 0), int):
+        raise PipelineError(f"{node}: priority must be an integer")
+    declared = [key for key in RESOURCES if spec.get(key) is not None]
+    if declared and (node == 'defaults' or node.startswith('DM_')):
+        raise PipelineError(f"{node}: only stagings take resource hints")
+    if declared and not {'worker_type', 'max_number_workers'} <= set(declared):
+        # A hint is a whole configuration, never mixed with a computed one.
+        raise PipelineError(f"{node}: worker_type and max_number_workers must be declared together")
+
+
+@lru_cache(maxsize=None)
+def load_pipeline(path=PIPELINE_PATH):
+    """
+    Load and validate the pipeline spec, once per path.
+
+    The spec is a JSON file with `defaults` and `nodes`, node -> {depends_on, worker_type,
+    number_shards, max_number_workers, recursive_processing, priority}. Every node a node depends on
+    must be declared. `recursive_processing` and `priority` not declared by a node are taken from
+    `defaults`. Resources are only hints of a staging, see `get_resources`.
+
+    Returns: dict
+        'nodes': node -> spec with the defaults applied, 'relations': node -> set of dependencies,
+        'order': tuple of frozensets, the toposorted nodes.
+
+    """
+    with open(path) as f:
+        spec = json.load(f)
+    unknown = set(spec) - {'defaults', 'nodes'}
+    if unknown:
+        raise PipelineError(f"unknown keys {sorted(unknown)}")
+    defaults = spec.get('defaults', {})
+    _check_node('defaults', defaults)
+    if not spec.get('nodes'):
+        raise PipelineError("no nodes declared")
+
+    nodes = {}
+    for node, node_spec in spec['nodes'].items():
+        _check_node(node, node_spec)
+        nodes[node] = {**defaults, **node_spec}
+        missing = set(nodes[node].get('depends_on', [])) - set(spec['nodes'])
+        if missing:
+            raise PipelineError(f"{node}: depends on undeclared nodes {sorted(missing)}")
+
+    relations = {node: frozenset(i.get('depends_on', [])) for node, i in nodes.items()}
+    try:
+        order = tuple(frozenset(i) for i in toposort(relations))
+    except CircularDependencyError as e:
+        raise PipelineError(str(e)) from e
+    return {'nodes': nodes, 'relations': relations, 'order': order}
+
+
+def get_relations():
+    """
+    Dependencies of each staging/DM of the pipeline.
+
+    Returns: dict
+        node -> set of nodes it depends on.
+
+    """
+    # Only nodes with dependencies, as before the spec declared the sources.
+    return {node: set(deps) for node, deps in load_pipeline()['relations'].items() if deps}
+
 
 def get_dag():
-    rel = {}
-    rel['DM_arinvoice'] = ['se1_invoice']
-    rel['se1_invoice'] = ['se1']
-    rel['DM_arinvoiceinstallment'] = ['se1_installments', 'DM_arinvoice']
-    rel['se1_installments'] = ['DM_arinvoice', 'se1']
-    rel['DM_arinvoicepayments'] = [
-        'DM_arinvoiceinstallment',
-        'fk1',
-        'fk5_estorno_transferencia_pagamento',
-        'fk5_transferencia',
-        'fkd_1',
-        'fkd_deletado',
-        'se1_acresc',
-        'se1_decresc',
-        'se1_payments',
-        'se1_payments_abatimentos',
-        'sea_1_frv_descontado_deletado_invoicepayment',
-        'sea_1_frv_descontado_naodeletado_invoicepayment']
-
-    rel['fk1'] = ['DM_arinvoiceinstallment']
-    rel['fk5_estorno_transferencia_pagamento'] = ['DM_arinvoiceinstallment']
-    rel['fk5_transferencia'] = ['DM_arinvoiceinstallment']
-    rel['fkd_1'] = ['DM_arinvoiceinstallment']
-    rel['fkd_deletado'] = ['DM_arinvoiceinstallment']
-    rel['se1_acresc'] = ['DM_arinvoiceinstallment', 'se1']
-    rel['se1_decresc'] = ['DM_arinvoiceinstallment', 'se1']
-    rel['se1_payments'] = ['DM_arinvoiceinstallment', 'se1']
-    rel['se1_payments_abatimentos'] = ['DM_arinvoiceinstallment', 'se1']
-    rel['sea_1_frv_descontado_deletado_invoicepayment'] = ['DM_arinvoiceinstallment']
-    rel['sea_1_frv_descontado_naodeletado_invoicepayment'] = ['DM_arinvoiceinstallment']
-
-    # APs
-    rel['DM_apinvoice'] = ['se2_invoice']
-    rel['se2_invoice'] = ['se2']
-
-    rel['DM_apinvoiceinstallment'] = ['DM_apinvoice', 'se2_installments']
-    rel['se2_installments'] = ['DM_apinvoice', 'se2']
-
-    rel['DM_apinvoicepayments'] = [
-        'DM_apinvoiceinstallment',
-        'fk2',
-        'se2_acresc',
-        'se2_decresc',
-        'se2_payments',
-        'se2_payments_abatimentos'
-    ]
-
-    rel['fk2'] = ['DM_apinvoiceinstallment']
-    rel['se2_acresc'] = ['DM_apinvoiceinstallment', 'se2']
-    rel['se2_decresc'] = ['DM_apinvoiceinstallment', 'se2']
-    rel['se2_payments'] = ['DM_apinvoiceinstallment', 'se2']
-    rel['se2_payments_abatimentos'] = ['DM_apinvoiceinstallment', 'se2']
-
-    rel['sea_1_frv_descontado_deletado_payments_bank'] = ['DM_apinvoicepayments']
-    rel['sea_1_frv_descontado_naodeletado_payments_bank'] = ['DM_apinvoicepayments']
-    rel['DM_arpaymentsbank'] = ['DM_apinvoicepayments', 'sea_1_frv_descontado_deletado_payments_bank', 'sea_1_frv_descontado_naodeletado_payments_bank']
-
-    rel = {i: set(j) for i, j in rel.items()}
-    dag_order = toposort(rel)
-
-    return dag_order
-
-
-def run_custom_pipeline(login, connector_name, logger):
-
-    if logger is None:
-        logger = logging.getLogger(login.domain)
-    dag = get_dag()
-
-    for p in dag:
-        dm = [i for i in p if i.startswith('DM_')]
-        stagings = [i for i in p if not i.startswith('DM_')]
-        tasks = []
-        if dm:
-            #play integration
-            # TODO: reprocess rejected?
-            pass
-
-        for staging_name in stagings:
-            mappings_ = carol_task.resume_process(login, connector_name=connector_name,
-                                                  staging_name=staging_name,logger=logger, delay=1)
-        #wait for play.
-        time.sleep(120)
-
-
-        for staging_name in stagings:
-            logger.debug(f"processing {staging_name}")
-            task_id = CDSStaging(login).process_data(staging_name, connector_name=connector_name, max_number_workers=16,
-                                                     delete_target_folder=False, delete_realtime_records=False,
-                                                     recursive_processing=False)
-            tasks += [task_id['data']['mdmId']]
-
-        task_list, fail = carol_task.track_tasks(login, tasks, logger=logger)
-
-        if fail:
-            return True
-
-    return False
+    return [set(i) for i in load_pipeline()['order']]
+
+
+def get_node(node):
+    """
+    Spec of a node, with the defaults applied.
+    """
+    return load_pipeline()['nodes'].get(node, {})
+
+
+def get_hint(node, n_records):
+    """
+    Resources hinted by the spec for a staging, None if it has no hint.
+
+    Returns: dict
+        worker_type, number_shards and max_number_workers. Shards not declared are computed from
+        `n_records`, as `sizing.default_sizing` does.
+    """
+    spec = get_node(node)
+    if spec.get('worker_type') is None:
+        return None
+    number_shards = spec.get('number_shards')
+    if number_shards is None:
+        number_shards = max(spec['max_number_workers'], round(n_records / 100000) + 1)
+    return {'worker_type': spec['worker_type'], 'number_shards': number_shards,
+            'max_number_workers': spec['max_number_workers']}
+
+
+def get_resources(node, n_records, sizing=None):
+    """
+    Arguments of the process_data task of a node.
+
+    The resources come from a single source: the history of `sizing`, if given and with enough samples,
+    else the hint of the spec, else `sizing.default_sizing`.
+    """
+    hint = get_hint(node, n_records)
+    if sizing is not None:
+        resources = sizing.choose('process', n_records, default=hint)
+    else:
+        resources = hint if hint is not None else default_sizing(n_records)
+    return dict(resources, recursive_processing=get_node(node).get('recursive_processing', False))
+
+
+def get_downstream(nodes, relations=None):
+    """
+    `nodes` and all the nodes depending on them, directly or not.
+
+    Args:
+        nodes: iterable
+            Pipeline nodes.
+        relations: dict
+            node -> dependencies. If None, uses `get_relations()`.
+
+    Returns: set
+
+    """
+    relations = relations if relations is not None else get_relations()
+    downstream = set(nodes)
+    stack = list(nodes)
+    while stack:
+        node = stack.pop()
+        for child, deps in relations.items():
+            if node in deps and child not in downstream:
+                downstream.add(child)
+                stack.append(child)
+    return downstream
+
+
+def get_dirty(changed, relations=None):
+    """
+    Nodes to delete and reprocess when the stagings in `changed` changed.
+
+    Deleting a DM drops the golden records fed by all its dependencies, and deleting a staging drops
+    the records generated by the stagings it depends on. So the dependencies of each dirty DM, and the
+    staging dependencies of each dirty staging, are reprocessed too, along with everything depending on
+    them.
+
+    Args:
+        changed: iterable
+            Changed stagings.
+        relations: dict
+            node -> dependencies. If None, uses `get_relations()`.
+
+    Returns: set
+
+    """
+    relations = relations if relations is not None else get_relations()
+    dirty = get_downstream(changed, relations)
+    while True:
+        upstream = set()
+        for node in dirty:
+            deps = relations.get(node, set())
+            upstream |= deps if node.startswith('DM_') else {i for i in deps if not i.startswith('DM_')}
+        if upstream <= dirty:
+            return dirty
+        dirty = get_downstream(dirty | upstream, relations)
+
+
+class DagScheduler:
+    """
+    Dependency driven scheduler for the custom pipeline.
+
+    Each staging is played and processed as soon as all its own dependencies are completed, instead of
+    waiting for the whole toposort level. A played staging is processed once its ETLs and mappings are
+    confirmed running, or after `play_timeout`. DMs have nothing to process, they are completed as soon
+    as their dependencies are. `poll` does a single non-blocking pass, so it can be driven by a plain
+    loop or by the async engine.
+
+    `poll` only calls Carol. The journal, sizing, admission and metrics writes it makes are queued and
+    applied by `flush`, which also chooses the resources and gets the admission slot of the stagings
+    waiting to be processed. Call `flush` after each `poll`; the engine runs it in its store thread.
+
+    Args:
+        login: pycarol.Carol
+            Carol() instance.
+        connector_name: str
+            Connector Name
+        logger:
+            Logger to be used. If None will use
+                logger = logging.getLogger(login.domain)
+        max_in_flight: int
+            Max number of stagings being played or processed at the same time.
+        play_timeout: float
+            Max seconds to wait for a played staging to be running before processing it anyway.
+        relations: dict
+            node -> dependencies. If None, uses `get_relations()`.
+        journal: journal.Journal
+            If given, nodes are recorded in it.
+        nodes: dict
+            Nodes recorded in the journal by an interrupted run, from `journal.get_nodes`. The ones
+            already completed or processing are picked up.
+        sizing: sizing.SizingHistory
+            If given, resources of each staging are chosen from the history. Without history, the hints of
+            the pipeline spec are used, else `sizing.default_sizing`. See `get_resources`.
+        metadata: metadata.TenantMetadata
+            Tenant metadata used for connector and mapping lookups.
+        admission: admission.AdmissionController
+            If given, each process_data waits for a fleet-wide slot before being created.
+        metrics: metrics.Metrics
+            If given, a span is recorded for each staging, from the time it is played until it is processed.
+        unchanged: iterable
+            Nodes whose data did not change since the last run. Their stagings are only played, nothing
+            is processed. Nodes recorded as `UNCHANGED` in the journal are added to them.
+
+    """
+
+    def __init__(self, login, connector_name, logger=None, max_in_flight=8, play_timeout=180, relations=None,
+                 journal=None, nodes=None, sizing=None, metadata=None, admission=None, metrics=None, unchanged=()):
+        if logger is None:
+            logger = logging.getLogger(login.domain)
+        self.login = login
+        self.connector_name = connector_name
+        self.logger = logger
+        self.max_in_flight = max_in_flight
+        self.play_timeout = play_timeout
+
+        relations = relations if relations is not None else get_relations()
+        self.deps = {node: set(deps) for node, deps in relations.items()}
+        for node in reduce(set.union, relations.values(), set()):
+            self.deps.setdefault(node, set())
+
+        # Start first the nodes with a higher priority in the spec, then the ones with more nodes
+        # depending on them.
+        children = {node: set() for node in self.deps}
+        for node, deps in self.deps.items():
+            for dep in deps:
+                children[dep].add(node)
+        self.priority = {node: (get_node(node).get('priority', 0), len(self._descendants(node, children)))
+                         for node in self.deps}
+
+        self.done = set()
+        self.playing = {}  # staging -> time it was played.
+        self.queued = []  # stagings played, waiting to be processed.
+        self.running = {}  # task id -> staging.
+        self.retry_tasks = defaultdict(int)
+        self.max_retries = set()
+        self.failed = False
+        self.created = []  # process_data tasks created.
+        self.metrics = metrics
+        self.spans = {}  # staging -> metrics.Span
+        self.unchanged = set(unchanged)  # nodes to play without processing.
+
+        self.sizing = sizing
+        self.metadata = metadata
+        self.admission = admission
+        self.records = {}  # staging -> number of records.
+        self.resources = {}  # staging -> resources chosen by `flush`.
+        self.admitted = set()  # stagings with an admission slot.
+        self.writes = []  # store calls queued by `poll`, applied by `flush`.
+        self.journal = journal
+        if nodes is not None:
+            for node, (task_id, status) in nodes.items():
+                if status == 'COMPLETED':
+                    self.done.add(node)
+                elif status == 'UNCHANGED':
+                    self.unchanged.add(node)
+                elif task_id is not None:
+                    self.running[task_id] = node
+                    self.start_span(node)
+
+    @staticmethod
+    def _descendants(node, children):
+        seen = set()
+        stack = [node]
+        while stack:
+            for child in children[stack.pop()]:
+                if child not in seen:
+                    seen.add(child)
+                    stack.append(child)
+        return seen
+
+    @property
+    def in_flight(self):
+        return len(self.playing) + len(self.queued) + len(self.running)
+
+    def ready(self):
+        started = self.done | set(self.playing) | set(self.queued) | set(self.running.values())
+        ready = [node for node, deps in self.deps.items() if node not in started and deps <= self.done]
+        return sorted(ready, key=lambda node: (-self.priority[node][0], -self.priority[node][1], node))
+
+    def start_span(self, staging_name):
+        if self.metrics is not None:
+            self.spans[staging_name] = self.metrics.start(self.login.domain, 'processing', node=staging_name)
+
+    def finish_span(self, staging_name, status, task_id=None):
+        span = self.spans.pop(staging_name, None)
+        if span is not None:
+            span.retries = self.retry_tasks[task_id] if task_id is not None else 0
+            self.write(self.metrics.finish, span, status)
+
+    def write(self, func, *args, **kwargs):
+        self.writes.append(partial(func, *args, **kwargs))
+
+    def flush(self):
+        """
+        Apply the store writes queued by `poll`, then choose the resources and get the admission slots of
+        the stagings waiting to be processed, in order.
+
+        Blocking, it only uses the local stores.
+        """
+        writes, self.writes = self.writes, []
+        for write in writes:
+            write()
+
+        for staging_name in self.queued:
+            if staging_name not in self.records:
+                break
+            if staging_name not in self.resources:
+                self.resources[staging_name] = get_resources(staging_name, self.records[staging_name],
+                                                             sizing=self.sizing)
+            if self.admission is not None and staging_name not in self.admitted:
+                key = f'{self.login.domain}/{staging_name}/process'
+                weight = admission_control.get_weight(self.records[staging_name])
+                if not self.admission.try_acquire(key, weight, tenant=self.login.domain):
+                    # First come first served, the next ones wait as well.
+                    break
+                self.admitted.add(staging_name)
+
+    def count(self, staging_name):
+        if staging_name not in self.records:
+            self.records[staging_name] = CDSStaging(self.login).count(staging_name=staging_name,
+                                                                      connector_name=self.connector_name)
+        return self.records[staging_name]
+
+    def process(self, staging_name):
+        """
+        Create the process_data task of a staging, once `flush` chose its resources and got its slot.
+
+        Returns: str
+            Task id, None if the staging is not ready to be processed yet.
+        """
+        self.count(staging_name)
+        resources = self.resources.get(staging_name)
+        if resources is None or (self.admission is not None and staging_name not in self.admitted):
+            return None
+
+        key = f'{self.login.domain}/{staging_name}/process'
+        self.logger.debug(f"processing {staging_name}")
+        try:
+            task_id = CDSStaging(self.login).process_data(staging_name, connector_name=self.connector_name,
+                                                          delete_target_folder=False, delete_realtime_records=False,
+                                                          **resources)
+        except Exception:
+            if self.admission is not None:
+                self.admitted.discard(staging_name)
+                self.write(self.admission.release, key)
+            raise
+        task_id = task_id['data']['mdmId']
+        del self.resources[staging_name]
+        self.admitted.discard(staging_name)
+        self.created.append(task_id)
+        if staging_name in self.spans:
+            self.spans[staging_name].tasks += 1
+        if self.admission is not None:
+            self.write(self.admission.attach, key, task_id)
+        if self.sizing is not None:
+            self.write(self.sizing.start, task_id, 'process', self.count(staging_name), resources,
+                       tenant=self.login.domain, staging=staging_name)
+        if self.journal is not None:
+            self.write(self.journal.set_node, self.login.domain, staging_name, 'RUNNING', task_id=task_id)
+        return task_id
+
+    def complete(self, node):
+        self.logger.debug(f"{node} completed")
+        self.done.add(node)
+        if self.journal is not None:
+            self.write(self.journal.set_node, self.login.domain, node, 'COMPLETED')
+
+    def poll(self):
+        """
+        Check running tasks, then start what is ready.
+
+        Returns: bool
+            True when there is nothing left to run.
+
+        """
+        if self.unchanged - self.done and not self.failed:
+            # Nothing to process, they only need to be playing again.
+            to_play = sorted(i for i in self.unchanged - self.done if not i.startswith('DM_'))
+            resumed = carol_task.par_resume_process(self.login, connector_name=self.connector_name,
+                                                    staging_list=to_play, logger=self.logger,
+                                                    metadata=self.metadata)
+            for staging_name, r in resumed.items():
+                if not r['success']:
+                    self.logger.error(f"Problem playing {staging_name}: {r['error']}")
+                    self.failed = True
+            for node in self.unchanged - self.done:
+                if resumed.get(node, {'success': True})['success']:
+                    self.complete(node)
+
+        if self.running:
+            task_status, _, _ = carol_task.check_tasks(self.login, list(self.running), self.retry_tasks,
+                                                       self.max_retries, logger=self.logger)
+            if self.sizing is not None:
+                self.write(self.sizing.finish, task_status['COMPLETED'])
+            if self.admission is not None:
+                self.write(self.admission.release_tasks,
+                           task_status['COMPLETED'] + list(self.max_retries & set(self.running)))
+            for task in task_status['COMPLETED']:
+                node = self.running.pop(task)
+                self.finish_span(node, 'ok', task_id=task)
+                self.complete(node)
+            for task in self.max_retries & set(self.running):
+                node = self.running.pop(task)
+                self.logger.error(f"{node} failed, stopping the pipeline.")
+                self.finish_span(node, 'failed', task_id=task)
+                self.failed = True
+
+        if self.playing:
+            playing = carol_task.get_playing(self.login, self.connector_name, list(self.playing),
+                                             metadata=self.metadata)
+            now = time.time()
+            for staging_name, played in list(self.playing.items()):
+                if staging_name not in playing:
+                    if now - played < self.play_timeout:
+                        continue
+                    self.logger.warning(f"{staging_name} not confirmed running, processing anyway.")
+                del self.playing[staging_name]
+                self.queued.append(staging_name)
+
+        for staging_name in list(self.queued):
+            task_id = self.process(staging_name)
+            if task_id is None:
+                # Not sized or admitted by `flush` yet, the next ones are not either.
+                for waiting in self.queued:
+                    # Counted here, `flush` does not call Carol.
+                    self.count(waiting)
+                break
+            self.queued.remove(staging_name)
+            self.running[task_id] = staging_name
+
+        while not self.failed:
+            ready = self.ready()
+            dms = [i for i in ready if i.startswith('DM_')]
+            if dms:
+                # TODO: reprocess rejected?
+                for dm in dms:
+                    self.complete(dm)
+                continue
+
+            to_play = ready[:max(self.max_in_flight - self.in_flight, 0)]
+            if to_play:
+                resumed = carol_task.par_resume_process(self.login, connector_name=self.connector_name,
+                                                        staging_list=to_play, logger=self.logger,
+                                                        metadata=self.metadata)
+                for staging_name, r in resumed.items():
+                    if r['success']:
+                        self.playing[staging_name] = time.time()
+                        self.start_span(staging_name)
+                    else:
+                        self.logger.error(f"Problem playing {staging_name}: {r['error']}")
+                        self.failed = True
+            break
+
+        return not (self.playing or self.queued or self.running) and (self.failed or not self.ready())
+
 
+def run_custom_pipeline(login, connector_name, logger, max_in_flight=8, metrics=None):
 
+    scheduler = DagScheduler(login, connector_name=connector_name, logger=logger, max_in_flight=max_in_flight,
+                             metrics=metrics)
+    while True:
+        done = scheduler.poll()
+        scheduler.flush()
+        if done:
+            break
+        time.sleep(round(10 + random.random() * 5, 2))
 
+    return scheduler.failed
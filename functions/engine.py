@@ -0,0 +1,839 @@
+import asyncio
+import itertools
+import logging
+import os
+import random
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, reduce
+
+from . import sheet_utils, carol_login, carol_apps, carol_task, custom_pipeline, techfin_task, log_utils
+from .metadata import TenantMetadata
+
+# Max concurrent calls per API.
+DEFAULT_LIMITS = {'carol': 50, 'sheet': 2, 'techfin': 10}
+
+FINAL_STATES = ['done', 'failed', 'skipped']
+
+# Sheet status written when a phase raises.
+FAILURES = {
+    'start': 'failed - fetching app version',
+    'drop_stagings': 'failed - dropping stagings',
+    'drop_etls': 'failed - dropping ETLs',
+    'check_version': 'failed - fetching app version',
+    'stop_pubsub': 'failed - stop pubsub',
+    'app_install': 'failed - app install',
+    'cancel_tasks': 'failed - canceling tasks',
+    'watermarks': 'failed - watermarks',
+    'consolidate': 'failed - consolidate',
+    'clear_pubsub': 'failed - stop pubsub',
+    'play_pubsub': 'failed - playing pubsub',
+    'delete_stagings': 'failed - delete stagings',
+    'delete_dms': 'failed - delete DMs',
+    'delete_payments': 'failed - delete payments techfin',
+    'processing': 'failed - processing',
+    'add_pubsub': 'failed - add pub/sub',
+    'finish': 'failed - finishing',
+}
+
+
+class Engine:
+    """
+    Run the reprocess of many tenants in a single event loop.
+
+    Blocking calls run in a thread pool and are limited per API. Waiting for Carol tasks is done with
+    `asyncio.sleep`, so a tenant waiting on its tasks does not hold a thread.
+
+    Args:
+        limits: dict
+            API name -> max concurrent calls. Keys are `carol`, `sheet` and `techfin`.
+        max_threads: int
+            Size of the thread pool used for blocking calls.
+        max_tenants: int
+            Max number of tenants running at the same time.
+        sheet_interval: float
+            Seconds between flushes of the sheet updates.
+        max_in_flight: int
+            Max number of stagings processing at the same time per tenant.
+        journal: journal.Journal
+            Journal used to record and resume tenant runs. If None, runs are not recorded.
+        sizing: sizing.SizingHistory
+            History used to size consolidate/process tasks. If None, the default sizing is used.
+        admission: admission.AdmissionController
+            Fleet-wide cap on heavy tasks. If None, heavy tasks are created right away.
+        worksheet: gspread.Worksheet
+            Status worksheet. If None, it is opened with `sheet_utils.get_client`.
+        time_scale: float
+            Factor applied to the engine sleeps between polls, lower it to run against a fake Carol.
+        metrics: metrics.Metrics
+            If given, a span is recorded for each phase of each tenant and for each processed staging.
+        incremental: bool
+            Only consolidate, delete and process the stagings changed since the last successful run, and
+            the nodes depending on them. Needs a journal.
+
+    """
+
+    def __init__(self, limits=None, max_threads=64, max_tenants=200, sheet_interval=10, max_in_flight=8,
+                 journal=None, sizing=None, admission=None, worksheet=None, time_scale=1.0, metrics=None,
+                 incremental=False):
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.journal = journal
+        self.sizing = sizing
+        self.admission = admission
+        self.metrics = metrics
+        self.incremental = incremental and journal is not None
+        # Shared by all tenants, so the techfin throttling is handled fleet-wide.
+        self.payments = techfin_task.PaymentsClient(max_concurrency=self.limits['techfin'])
+        self.max_threads = max_threads
+        self.max_tenants = max_tenants
+        self.max_in_flight = max_in_flight
+        self.sheet_interval = sheet_interval
+        self.worksheet = worksheet
+        self.time_scale = time_scale
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._executor = None
+        self._store_executor = None
+        self._loop = None
+        self._semaphores = {}
+        self._batchers = {}
+
+    def _check_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # Semaphores and batchers are bound to the loop, each `asyncio.run` needs new ones.
+            self._loop = loop
+            self._semaphores = {}
+            self._batchers = {}
+
+    def _semaphore(self, api):
+        self._check_loop()
+        if api not in self._semaphores:
+            self._semaphores[api] = asyncio.Semaphore(self.limits[api])
+        return self._semaphores[api]
+
+    async def call(self, api, func, *args, **kwargs):
+        """
+        Run a blocking call in the thread pool, holding a slot of `api`.
+        """
+        async with self._semaphore(api):
+            return await self.call_long(func, *args, **kwargs)
+
+    def batcher(self, name, api, func, **kwargs):
+        """
+        `Batcher` of `func` shared by all tenants. `kwargs` are only used the first time.
+        """
+        self._check_loop()
+        if name not in self._batchers:
+            self._batchers[name] = Batcher(self, api, func, **kwargs)
+        return self._batchers[name]
+
+    async def call_long(self, func, *args, **kwargs):
+        """
+        Run a long blocking call (e.g. one that tracks tasks itself) without holding any API slot.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_threads)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    async def store(self, func, *args, **kwargs):
+        """
+        Run a call to the local stores (journal, sizing, admission, metrics) in their own thread.
+
+        SQLite may wait for locks held by other processes, this never blocks the event loop nor a thread
+        of the API calls.
+        """
+        if self._store_executor is None:
+            self._store_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='store')
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._store_executor, partial(func, *args, **kwargs))
+
+    def get_writer(self):
+        """
+        Sheet writer shared by all tenants, so their updates go out in the same batch.
+        """
+        with self._writer_lock:
+            if self._writer is None:
+                worksheet = self.worksheet if self.worksheet is not None else sheet_utils.get_client()
+                self._writer = sheet_utils.SheetWriter(worksheet, interval=self.sheet_interval).start()
+            return self._writer
+
+    async def flush_sheet(self):
+        if self._writer is not None:
+            await self.call('sheet', self._writer.flush)
+
+    async def sleep(self, low, high):
+        await asyncio.sleep(round((low + random.random() * (high - low)) * self.time_scale, 2))
+
+    async def wait_for(self, probe, timeout=300, delay=2, max_delay=30):
+        """
+        Call `probe`, a blocking function without arguments, with exponential backoff until it returns True.
+
+        Returns: bool
+            True if it did before `timeout` seconds.
+        """
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        while True:
+            if await self.call('carol', probe):
+                return True
+            if loop.time() - start + delay > timeout:
+                return False
+            await asyncio.sleep(delay * self.time_scale)
+            delay = min(delay * 2, max_delay)
+
+    async def track_tasks(self, login, task_list, do_not_retry=False, logger=None, retry_tasks=None,
+                          callback=None):
+        """
+        Async version of `carol_task.track_tasks`. `retry_tasks`, if given, is updated with the retries.
+
+        `callback`, if given, is a blocking function called in the thread pool before each poll, it should
+        throttle itself, see `carol_task.TaskCanceller`.
+        """
+        if retry_tasks is None:
+            retry_tasks = defaultdict(int)
+        max_retries = set()
+        while True:
+            if callback is not None:
+                await self.call('carol', callback)
+            task_status, finished, fail = await self.call('carol', carol_task.check_tasks, login, task_list,
+                                                          retry_tasks, max_retries, do_not_retry=do_not_retry,
+                                                          logger=logger)
+            if finished:
+                return task_status, fail
+            await self.sleep(10, 15)
+
+    async def run_tenant(self, domain, org='totvstechfin', entry=None, resume=False):
+        try:
+            return await TenantRun(self, domain, org=org, entry=entry, resume=resume).run()
+        finally:
+            await self.flush_sheet()
+
+    def largest_first(self):
+        """
+        Priority function running the tenants with more records first. Tenants never sized go first, they
+        may be the largest ones.
+        """
+        records = self.sizing.tenant_records() if self.sizing is not None else {}
+        return lambda domain: -records.get(domain, float('inf'))
+
+    async def serve(self, refresh, interval=240, policy=None, org='totvstechfin'):
+        """
+        Keep `max_tenants` workers busy with the tenants returned by `refresh`.
+
+        `refresh` is called every `interval` seconds. New tenants are queued right away, a worker picks
+        the next one as soon as it is free, without waiting for the other tenants of the sweep.
+
+        Args:
+            refresh: callable
+                Blocking function returning `(tenants, index, resume)`, or None to stop once the queue is
+                drained. `index` is the sheet index and `resume` the tenants to resume from the journal.
+            interval: float
+                Seconds between calls to `refresh`.
+            policy: callable
+                Called after each refresh, returns a function tenant -> priority (lower runs first).
+                If None, tenants run in the order they are returned.
+            org: str
+                Organization name.
+
+        """
+        queue = asyncio.PriorityQueue()
+        counter = itertools.count()
+        pending = set()
+        entries = {}
+
+        async def worker():
+            while True:
+                _, _, domain, resume = await queue.get()
+                try:
+                    await self.run_tenant(domain, org=org, entry=entries.get(domain), resume=resume)
+                except Exception:
+                    logging.getLogger(domain).error(f"error running {domain}", exc_info=1)
+                finally:
+                    pending.discard(domain)
+                    queue.task_done()
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(self.max_tenants)]
+        try:
+            while True:
+                r = await self.call('sheet', refresh)
+                if r is None:
+                    break
+                tenants, index, resume = r
+                entries.update(index)
+                priority = await self.store(policy) if policy is not None else (lambda domain: 0)
+                for domain in tenants:
+                    if domain in pending:
+                        continue
+                    pending.add(domain)
+                    queue.put_nowait((priority(domain), next(counter), domain, domain in resume))
+                await asyncio.sleep(interval)
+            await queue.join()
+        finally:
+            for w in workers:
+                w.cancel()
+
+
+class Batcher:
+    """
+    Group the calls of many tenants into calls of `func` with a list of tenants.
+
+    A batch is sent `delay` seconds after its first tenant, or as soon as it has `max_batch` tenants.
+
+    Args:
+        engine: Engine
+            Engine running the calls.
+        api: str
+            API slot held by each batched call.
+        func: callable
+            Blocking function taking a list of tenants and returning a dict tenant -> result.
+        max_batch: int
+            Max number of tenants per call.
+        delay: float
+            Seconds to wait for other tenants before sending a batch.
+
+    """
+
+    def __init__(self, engine, api, func, max_batch=100, delay=5):
+        self.engine = engine
+        self.api = api
+        self.func = func
+        self.max_batch = max_batch
+        self.delay = delay
+        self._pending = []
+        self._timer = None
+
+    async def submit(self, tenant):
+        """
+        Add `tenant` to the next batch and wait for its result.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((tenant, future))
+        if len(self._pending) >= self.max_batch:
+            self._send()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.delay * self.engine.time_scale, self._send)
+        return await future
+
+    def _send(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch):
+        try:
+            results = await self.engine.call(self.api, self.func, [tenant for tenant, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for tenant, future in batch:
+            if not future.done():
+                future.set_result(results.get(tenant))
+
+
+class TenantRun:
+    """
+    Reprocess of a single tenant as a state machine.
+
+    Each state `<name>` is handled by the coroutine `_<name>`, which returns the next state. If a
+    phase raises, the sheet status is set to the matching entry of `FAILURES` and the run stops.
+
+    When the engine has a journal, each transition and the tasks created by each phase are recorded.
+    A resumed run starts at the recorded state and tracks the recorded tasks instead of creating new ones.
+
+    Args:
+        engine: Engine
+            Engine used to run blocking calls.
+        domain: str
+            Tenant name.
+        org: str
+            Organization name.
+        entry: dict
+            Row of the tenant from `sheet_utils.build_index`. If None, the tenant is searched in the sheet.
+        resume: bool
+            Resume the unfinished run recorded in the journal, if any.
+
+    """
+
+    app_name = "techfinplatform"
+    app_version = '0.0.70'
+    connector_name = 'protheus_carol'
+    connector_group = 'protheus'
+    consolidate_list = ['se1', 'se2', ]
+    compute_transformations = True  # need to force the old data to the stagings transformation.
+
+    def __init__(self, engine, domain, org='totvstechfin', entry=None, resume=False):
+        self.engine = engine
+        self.journal = engine.journal
+        self.entry = entry
+        self.domain = domain
+        self.org = org
+        self.state = 'start'
+        self.task_list = '__unk__'
+        self.logger = None
+        self.login = None
+        self.metadata = None
+        self.worksheet = None
+        self.row = None
+        self.current_version = None
+        self.resume_state = None
+        self.span = None
+        self.dirty = None  # nodes to reprocess, None for all.
+        self.resume = resume
+
+        dag = list(reduce(set.union, custom_pipeline.get_dag()))
+        self.dms = [i.replace('DM_', '') for i in dag if i.startswith('DM_')]
+        self.staging_list = [i for i in dag if not i.startswith('DM_')]
+
+    async def run(self):
+        metrics = self.engine.metrics
+        total = metrics.start(self.domain, 'total') if metrics is not None else None
+        if self.resume and self.journal is not None:
+            self.resume_state = await self.engine.store(self.journal.get_state, self.domain)
+            if self.resume_state is not None:
+                self.state = 'resume'
+        try:
+            while self.state not in FINAL_STATES:
+                state = self.state
+                self.span = metrics.start(self.domain, state) if metrics is not None else None
+                log_utils.set_phase(self.domain, state)
+                try:
+                    self.state = await getattr(self, f'_{state}')()
+                except Exception:
+                    logger = self.logger or logging.getLogger(self.domain)
+                    logger.error(f"error in {state} {self.domain}", exc_info=1)
+                    if self.row is None:
+                        # Tenant not found in the sheet, nowhere to write the status.
+                        self.state = 'failed'
+                    else:
+                        self.state = await self.fail(FAILURES.get(state, 'failed'))
+                finally:
+                    if self.span is not None:
+                        await self.engine.store(metrics.finish, self.span,
+                                                'failed' if self.state in (state, 'failed') else 'ok')
+                    await self.engine.store(self.record)
+        finally:
+            if self.engine.admission is not None:
+                # Whatever happened, the tasks of the tenant are not tracked anymore.
+                await self.engine.store(self.engine.admission.release_tenant, self.domain)
+        if total is not None:
+            await self.engine.store(metrics.finish, total, self.state)
+        return self.task_list
+
+    def record(self):
+        # Blocking, run through `Engine.store`.
+        if self.journal is not None and self.journal.get_state(self.domain) is not None:
+            self.journal.set_state(self.domain, self.state, finished=self.state in FINAL_STATES)
+
+    def count_tasks(self, task_list, retry_tasks):
+        """
+        Add tracked tasks and their retries to the span of the current phase.
+        """
+        if self.span is not None:
+            self.span.tasks += len(task_list)
+            self.span.retries += sum(retry_tasks.values())
+
+    def changed(self, node):
+        return self.dirty is None or node in self.dirty
+
+    async def journal_tasks(self):
+        """
+        Tasks already created by the current phase, if it is being resumed.
+        """
+        if self.journal is None:
+            return None
+        return await self.engine.store(self.journal.get_tasks, self.domain, self.state)
+
+    async def carol(self, func, *args, **kwargs):
+        return await self.engine.call('carol', func, self.login, *args, **kwargs)
+
+    async def sheet(self, func, *args):
+        return await self.engine.call('sheet', func, self.worksheet, self.row, *args)
+
+    def write(self, func, *args):
+        # Updates are buffered by the sheet writer, no need to go through the thread pool.
+        func(self.worksheet, self.row, *args)
+
+    async def set_status(self, status):
+        self.write(sheet_utils.update_status, status)
+
+    async def fail(self, status, message=None):
+        if message is not None:
+            self.logger.error(message)
+        await self.set_status(status)
+        return 'failed'
+
+    async def consolidate(self, staging_list):
+        """
+        Create the consolidate tasks of `staging_list`, each one once admitted by the admission controller.
+
+        Admission is polled from the event loop, so no thread is held while waiting for a slot and the
+        tasks freeing the slots keep being tracked.
+        """
+        admission = self.engine.admission
+        sized = {}
+        for staging_name in staging_list:
+            sized[staging_name] = await self.carol(carol_task.get_sizing, staging_name, self.connector_name,
+                                                   'consolidate', sizing=self.engine.sizing)
+        task_list = []
+        pending = list(staging_list)
+        while pending:
+            for staging_name in list(pending):
+                task_id = await self.carol(carol_task.par_consolidate, staging_name, self.connector_name,
+                                           compute_transformations=self.compute_transformations,
+                                           sizing=self.engine.sizing, admission=admission,
+                                           sized=sized[staging_name])
+                if task_id is None:
+                    # First come first served, the next ones will not get a slot either.
+                    break
+                pending.remove(staging_name)
+                task_list.append(task_id['data']['mdmId'])
+            if pending:
+                await self.engine.sleep(10, 15)
+        return task_list
+
+    async def track(self, task_list):
+        self.task_list = task_list
+        if self.journal is not None:
+            await self.engine.store(self.journal.save_tasks, self.domain, self.state, task_list)
+        retry_tasks = defaultdict(int)
+        self.task_list, fail = await self.engine.track_tasks(self.login, task_list, logger=self.logger,
+                                                             retry_tasks=retry_tasks)
+        self.count_tasks(task_list, retry_tasks)
+        if self.engine.admission is not None:
+            await self.engine.store(self.engine.admission.release_tasks, task_list)
+        if self.engine.sizing is not None:
+            await self.engine.store(self.engine.sizing.finish, self.task_list['COMPLETED'])
+        return fail
+
+    async def track_stream(self, func, *args, **kwargs):
+        """
+        Create tasks with `func`, a generator of task ids, tracking each task as soon as it is created.
+
+        Each task is recorded in the journal before the next one is created. If the phase is resumed
+        before the stream finished, the recorded tasks are tracked again and the stream is run again.
+
+        Returns: bool
+            fail status.
+        """
+        watcher = carol_task.TaskWatcher(self.login, logger=self.logger, keep_open=True)
+        submitted = []
+        if self.journal is not None:
+            submitted = await self.engine.store(self.journal.get_stream_tasks, self.domain, self.state)
+            watcher.add(submitted)
+        loop = asyncio.get_running_loop()
+
+        def submit():
+            try:
+                for task in func(self.login, *args, **kwargs):
+                    if self.journal is not None:
+                        save = self.engine.store(self.journal.add_stream_task, self.domain, self.state, task)
+                        asyncio.run_coroutine_threadsafe(save, loop).result()
+                    submitted.append(task)
+                    watcher.add([task])
+            finally:
+                watcher.close()
+
+        submission = asyncio.ensure_future(self.engine.call_long(submit))
+        while True:
+            for task, old_status, new_status in await self.engine.call('carol', watcher.poll):
+                self.logger.debug(f'{task}: {old_status} -> {new_status}')
+            if watcher.done and submission.done():
+                break
+            await self.engine.sleep(10, 15)
+        # raise errors from the submission, if any.
+        await submission
+
+        if self.journal is not None:
+            await self.engine.store(self.journal.save_tasks, self.domain, self.state, submitted)
+        self.count_tasks(submitted, watcher.retry_tasks)
+        self.task_list = watcher.task_status()
+        if self.engine.sizing is not None:
+            await self.engine.store(self.engine.sizing.finish, self.task_list['COMPLETED'])
+        return watcher.fail
+
+    async def is_painel(self):
+        if self.entry is None:
+            self.entry = {'row': self.row, 'sync_type': await self.sheet(sheet_utils.get_sync_type)}
+        return 'painel' in self.entry['sync_type'].lower().strip()
+
+    async def setup(self):
+        self.logger = log_utils.get_logger(self.domain, os.environ.get('SLACK'))
+        self.worksheet = await self.engine.call('sheet', self.engine.get_writer)
+
+        if self.entry is not None:
+            self.row = self.entry['row']
+            status = self.entry['status'].lower()
+        else:
+            current_cell = await self.engine.call('sheet', sheet_utils.find_tenant, self.worksheet, self.domain)
+            self.row = current_cell.row
+            row_values = await self.engine.call('sheet', self.worksheet.row_values, self.row)
+            status = row_values[-1].strip().lower()
+        return status
+
+    async def _resume(self):
+        await self.setup()
+        self.logger.info(f"Resuming {self.domain} from {self.resume_state}")
+        self.login = await self.engine.call('carol', carol_login.get_login, self.domain, self.org, self.app_name)
+        self.metadata = TenantMetadata(self.login)
+        if self.engine.incremental:
+            nodes = await self.engine.store(self.journal.get_nodes, self.domain)
+            unchanged = {node for node, (_, status) in nodes.items() if status == 'UNCHANGED'}
+            if unchanged:
+                self.dirty = set(itertools.chain.from_iterable(custom_pipeline.get_dag())) - unchanged
+        return self.resume_state
+
+    async def _start(self):
+        # avoid all tasks starting at the same time.
+        await self.engine.sleep(3, 9)
+        status = await self.setup()
+
+        skip_status = ['done', 'failed', 'wait', 'running', 'installing', 'reprocessing']
+        if any(i in status for i in skip_status):
+            self.logger.info(f"Nothing to do in {self.domain}, status {status}")
+            return 'skipped'
+
+        self.login = await self.engine.call('carol', carol_login.get_login, self.domain, self.org, self.app_name)
+        self.metadata = TenantMetadata(self.login)
+        self.write(sheet_utils.update_start_time)
+        if self.journal is not None:
+            await self.engine.store(self.journal.start, self.domain)
+
+        current_version = await self.carol(carol_apps.get_app_version, self.app_name, self.app_version,
+                                           metadata=self.metadata)
+        if current_version != self.app_version and current_version < "0.0.63":
+            return 'drop_stagings'
+        return 'check_version'
+
+    async def _drop_stagings(self):
+        await self.set_status("running - drop stagings")
+        self.logger.info(f"Starting process {self.domain}")
+        st = await self.carol(carol_task.get_all_stagings, connector_name=self.connector_name,
+                              metadata=self.metadata)
+        st = [i for i in st if i.startswith('se1_') or i.startswith('se2_')]
+        tasks, fail = await self.journal_tasks(), False
+        if tasks is None:
+            tasks, fail = await self.carol(carol_task.drop_staging, staging_list=st,
+                                           connector_name=self.connector_name, logger=self.logger,
+                                           metadata=self.metadata)
+        if fail:
+            return await self.fail("failed - dropping stagings", f"error dropping staging {self.domain}")
+        await self.track(tasks)
+        return 'drop_etls'
+
+    async def _drop_etls(self):
+        await self.set_status("running - drop ETLs")
+        to_drop = ['se1', 'se2']
+        etls = await self.engine.call('carol', self.metadata.etls, self.connector_name)
+        to_delete = [i for i in etls if (i['mdmSourceEntityName'] in to_drop)]
+        await self.carol(carol_task.drop_etls, etl_list=to_delete, metadata=self.metadata)
+        return 'check_version'
+
+    async def _check_version(self):
+        current_version = await self.carol(carol_apps.get_app_version, self.app_name, self.app_version,
+                                           metadata=self.metadata)
+        if current_version != self.app_version:
+            self.current_version = current_version
+            return 'stop_pubsub'
+
+        self.logger.info(f"Running version {self.app_version}")
+        self.write(sheet_utils.update_version, self.app_version)
+        await self.set_status("Done")
+        self.write(sheet_utils.update_end_time)
+        return 'done'
+
+    async def _stop_pubsub(self):
+        await self.set_status("running - stop pubsub")
+        await self.carol(carol_task.pause_and_clear_subscriptions, self.dms, self.logger)
+        return 'app_install'
+
+    async def _app_install(self):
+        if self.current_version is not None:
+            # Not known when resuming, the running install is tracked again.
+            self.logger.info(f"Updating app from {self.current_version} to {self.app_version}")
+            self.write(sheet_utils.update_version, self.current_version)
+        await self.set_status("running - app install")
+        # Processing tasks created while the app installs are cancelled, at most once a minute.
+        canceller = carol_task.TaskCanceller(self.login, logger=self.logger)
+        retry_tasks = defaultdict(int)
+        running = await self.carol(carol_apps.get_running_install)
+        if running is not None:
+            self.logger.info(f'Found install task in {self.domain}')
+            self.task_list, installing_version = running
+            try:
+                await self.engine.track_tasks(self.login, [self.task_list], logger=self.logger,
+                                              retry_tasks=retry_tasks, callback=canceller)
+            except Exception:
+                self.logger.error("error fetching already running task, will try again", exc_info=1)
+            else:
+                if installing_version == self.app_version:
+                    # installing the app changes stagings, ETLs and mappings.
+                    self.metadata.invalidate()
+                    self.write(sheet_utils.update_version, self.app_version)
+                    self.count_tasks([self.task_list], retry_tasks)
+                    return 'cancel_tasks'
+
+        self.task_list = await self.carol(carol_apps.submit_install, self.app_name, self.app_version, self.logger,
+                                          connector_group=self.connector_group, metadata=self.metadata)
+        self.write(sheet_utils.update_version, self.app_version)
+        if self.task_list == '__unk__':
+            return await self.fail('failed - app install')
+        try:
+            _, fail = await self.engine.track_tasks(self.login, [self.task_list], logger=self.logger,
+                                                    retry_tasks=retry_tasks, callback=canceller)
+        except Exception:
+            self.logger.error("error after app install", exc_info=1)
+            fail = True
+        self.count_tasks([self.task_list], retry_tasks)
+        if fail:
+            self.logger.error(f"Problem with {self.domain} during App installation task = {self.task_list}.")
+            return await self.fail('failed - app install')
+        return 'cancel_tasks'
+
+    async def _cancel_tasks(self):
+        # Cancel unwanted tasks.
+        await self.set_status("running - canceling tasks")
+        pross_tasks = await self.carol(carol_task.find_task_types)
+        pross_task = [i['mdmId'] for i in pross_tasks]
+        if pross_task:
+            await self.carol(carol_task.cancel_tasks, pross_task)
+
+        # pause ETLs.
+        await self.carol(carol_task.pause_etls, etl_list=self.staging_list, connector_name=self.connector_name,
+                         logger=self.logger, metadata=self.metadata)
+        # pause mappings.
+        await self.carol(carol_task.pause_dms, dm_list=self.dms, connector_name=self.connector_name, )
+        # wait for the pause to have effect.
+        paused = await self.engine.wait_for(partial(carol_task.is_paused, self.login, self.connector_name,
+                                                    self.staging_list, self.dms, metadata=self.metadata))
+        if not paused:
+            self.logger.warning(f"ETLs/mappings not confirmed paused in {self.domain}")
+        if self.engine.incremental:
+            return 'watermarks'
+        return 'consolidate'
+
+    async def _watermarks(self):
+        previous = await self.engine.store(self.journal.get_watermarks, self.domain)
+        if not previous:
+            self.logger.info(f"No watermarks for {self.domain}, reprocessing everything")
+            return 'consolidate'
+        current = await self.carol(carol_task.get_watermarks, self.connector_name, self.staging_list,
+                                   metadata=self.metadata)
+        changed = carol_task.changed_stagings(previous, current)
+        self.dirty = custom_pipeline.get_dirty(changed)
+        nodes = set(itertools.chain.from_iterable(custom_pipeline.get_dag()))
+        # Picked up by the scheduler of the processing phase, and by `_resume`.
+        for node in nodes - self.dirty:
+            await self.engine.store(self.journal.set_node, self.domain, node, 'UNCHANGED')
+        self.logger.info(f"{len(changed)} stagings changed in {self.domain}, reprocessing {len(self.dirty)} "
+                         f"of {len(nodes)} nodes")
+        return 'consolidate'
+
+    async def _consolidate(self):
+        await self.set_status("running - consolidate")
+        if self.engine.admission is not None:
+            await self.carol(self.engine.admission.reconcile)
+        staging_list = [i for i in self.consolidate_list if self.changed(i)]
+        task_list = await self.journal_tasks()
+        if task_list is None and self.engine.admission is not None:
+            task_list = await self.consolidate(staging_list)
+        elif task_list is None:
+            task_list = await self.carol(carol_task.consolidate_stagings, connector_name=self.connector_name,
+                                         staging_list=staging_list, n_jobs=1, logger=self.logger,
+                                         compute_transformations=self.compute_transformations,
+                                         sizing=self.engine.sizing)
+        if await self.track(task_list):
+            return await self.fail("failed - consolidate", "error after consolidate")
+        return 'clear_pubsub'
+
+    async def _clear_pubsub(self):
+        # Stop pub/sub if any.
+        await self.set_status("running - stop pubsub")
+        await self.carol(carol_task.pause_and_clear_subscriptions, self.dms, self.logger)
+        return 'play_pubsub'
+
+    async def _play_pubsub(self):
+        await self.carol(carol_task.play_subscriptions, self.dms, self.logger)
+        return 'delete_stagings'
+
+    async def _delete_stagings(self):
+        await self.set_status("running - delete stagings")
+        st = await self.carol(carol_task.get_all_stagings, connector_name=self.connector_name,
+                              metadata=self.metadata)
+        st = [i for i in st if (i.startswith('se1_') or i.startswith('se2_')) and self.changed(i)]
+        task_list = await self.journal_tasks()
+        if task_list is None:
+            fail = await self.track_stream(carol_task.iter_delete_staging, staging_list=st,
+                                           connector_name=self.connector_name)
+        else:
+            fail = await self.track(task_list)
+        if fail:
+            return await self.fail("failed - delete stagings", "error after delete stagings")
+        return 'delete_dms'
+
+    async def _delete_dms(self):
+        await self.set_status("running - delete DMs")
+        task_list = await self.journal_tasks()
+        if task_list is None:
+            dms = [i for i in self.dms if self.changed(f'DM_{i}')]
+            fail = await self.track_stream(carol_task.iter_delete_golden, dm_list=dms, metadata=self.metadata)
+        else:
+            fail = await self.track(task_list)
+        if fail:
+            return await self.fail("failed - delete DMs", "error after delete DMs")
+        return 'delete_payments'
+
+    async def _delete_payments(self):
+        if await self.is_painel():
+            await self.set_status("running - delete payments techfin")
+            r = await self.engine.payments.delete(self.domain)
+            if not r['success']:
+                return await self.fail("failed - delete payments techfin",
+                                       f"error deleting payments {self.domain}: {r['status_code']} {r['error']}")
+        return 'processing'
+
+    async def _processing(self):
+        await self.set_status("running - processing")
+        nodes = await self.engine.store(self.journal.get_nodes, self.domain) if self.journal is not None else None
+        scheduler = custom_pipeline.DagScheduler(self.login, connector_name=self.connector_name, logger=self.logger,
+                                                 max_in_flight=self.engine.max_in_flight, journal=self.journal,
+                                                 nodes=nodes, sizing=self.engine.sizing, metadata=self.metadata,
+                                                 admission=self.engine.admission, metrics=self.engine.metrics)
+        while True:
+            done = await self.engine.call('carol', scheduler.poll)
+            await self.engine.store(scheduler.flush)
+            if done:
+                break
+            await self.engine.sleep(10, 15)
+        self.count_tasks(scheduler.created, scheduler.retry_tasks)
+        if scheduler.failed:
+            return await self.fail("failed - processing", "error after processing")
+        return 'add_pubsub'
+
+    async def _add_pubsub(self):
+        if await self.is_painel():
+            await self.set_status("running - add pub/sub")
+            # Tenants reaching this phase together are subscribed in a single request.
+            r = await self.engine.batcher('add_pubsub', 'techfin', techfin_task.add_pubsub).submit(self.domain)
+            if not r['success']:
+                return await self.fail("failed - add pub/sub", f"error adding pub/sub {self.domain}: {r['error']}")
+        return 'finish'
+
+    async def _finish(self):
+        if self.journal is not None:
+            # Baseline of the next incremental run.
+            watermarks = await self.carol(carol_task.get_watermarks, self.connector_name, self.staging_list,
+                                          metadata=self.metadata)
+            await self.engine.store(self.journal.set_watermarks, self.domain, watermarks)
+        self.logger.info(f"Finished all process {self.domain}")
+        await self.set_status("Done")
+        self.write(sheet_utils.update_end_time)
+        return 'done'
@@ -0,0 +1,171 @@
+import json
+import os
+import socket
+import sqlite3
+import time
+from contextlib import closing
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    tenant TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    finished INTEGER NOT NULL DEFAULT 0,
+    host TEXT,
+    pid INTEGER,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS phase_tasks (
+    tenant TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    task_ids TEXT NOT NULL,
+    PRIMARY KEY (tenant, phase)
+);
+CREATE TABLE IF NOT EXISTS stream_tasks (
+    tenant TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    PRIMARY KEY (tenant, phase, task_id)
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    tenant TEXT NOT NULL,
+    node TEXT NOT NULL,
+    task_id TEXT,
+    status TEXT NOT NULL,
+    PRIMARY KEY (tenant, node)
+);
+CREATE TABLE IF NOT EXISTS watermarks (
+    tenant TEXT NOT NULL,
+    staging TEXT NOT NULL,
+    n_records INTEGER,
+    last_updated TEXT,
+    updated_at REAL,
+    PRIMARY KEY (tenant, staging)
+);
+"""
+
+
+class Journal:
+    """
+    Durable record of the progress of each tenant run.
+
+    Stores the state a tenant run is in (the phase being executed), the Carol tasks created by each
+    phase and the status of each node of the custom pipeline, so a run interrupted by a crash can be
+    resumed where it stopped.
+
+    Also keeps, across runs, the watermarks of the stagings after the last successful run of each tenant.
+
+    Args:
+        path: str
+            SQLite database file.
+
+    """
+
+    def __init__(self, path='journal.db'):
+        self.path = path
+        with closing(self._connect()) as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        # One connection per call, so the journal can be used from any thread.
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _execute(self, query, params=()):
+        with closing(self._connect()) as conn:
+            with conn:
+                return conn.execute(query, params).fetchall()
+
+    def start(self, tenant, state='start'):
+        """
+        Start a new run for `tenant`, dropping what was recorded for the previous one.
+        """
+        with closing(self._connect()) as conn:
+            with conn:
+                conn.execute("DELETE FROM phase_tasks WHERE tenant = ?", (tenant,))
+                conn.execute("DELETE FROM stream_tasks WHERE tenant = ?", (tenant,))
+                conn.execute("DELETE FROM nodes WHERE tenant = ?", (tenant,))
+                conn.execute("INSERT OR REPLACE INTO runs (tenant, state, finished, host, pid, updated_at) "
+                             "VALUES (?, ?, 0, ?, ?, ?)",
+                             (tenant, state, socket.gethostname(), os.getpid(), time.time()))
+
+    def set_state(self, tenant, state, finished=False):
+        self._execute("UPDATE runs SET state = ?, finished = ?, updated_at = ? WHERE tenant = ?",
+                      (state, int(finished), time.time(), tenant))
+
+    def get_state(self, tenant):
+        """
+        Returns: str
+            State of the unfinished run of `tenant`, None if there is none.
+        """
+        r = self._execute("SELECT state FROM runs WHERE tenant = ? AND finished = 0", (tenant,))
+        return r[0][0] if r else None
+
+    def unfinished(self):
+        """
+        Returns: list
+            Tenants whose last run did not finish.
+        """
+        return [i[0] for i in self._execute("SELECT tenant FROM runs WHERE finished = 0 ORDER BY updated_at")]
+
+    def save_tasks(self, tenant, phase, task_ids):
+        self._execute("INSERT OR REPLACE INTO phase_tasks (tenant, phase, task_ids) VALUES (?, ?, ?)",
+                      (tenant, phase, json.dumps(list(task_ids))))
+
+    def get_tasks(self, tenant, phase):
+        """
+        Returns: list
+            Tasks created by `phase` in the current run, None if the phase did not create them yet.
+        """
+        r = self._execute("SELECT task_ids FROM phase_tasks WHERE tenant = ? AND phase = ?", (tenant, phase))
+        return json.loads(r[0][0]) if r else None
+
+    def add_stream_task(self, tenant, phase, task_id):
+        """
+        Record a task as soon as it is created by a phase still creating tasks, see `save_tasks` once done.
+        """
+        self._execute("INSERT OR IGNORE INTO stream_tasks (tenant, phase, task_id) VALUES (?, ?, ?)",
+                      (tenant, phase, task_id))
+
+    def get_stream_tasks(self, tenant, phase):
+        """
+        Returns: list
+            Tasks recorded with `add_stream_task` by `phase` in the current run.
+        """
+        return [i[0] for i in self._execute("SELECT task_id FROM stream_tasks WHERE tenant = ? AND phase = ?",
+                                            (tenant, phase))]
+
+    def set_node(self, tenant, node, status, task_id=None):
+        self._execute("INSERT OR REPLACE INTO nodes (tenant, node, task_id, status) VALUES (?, ?, ?, ?)",
+                      (tenant, node, task_id, status))
+
+    def set_watermarks(self, tenant, watermarks):
+        """
+        Args:
+            tenant: str
+                Tenant name.
+            watermarks: dict
+                staging -> {'n_records': int, 'last_updated': str or None}
+        """
+        now = time.time()
+        with closing(self._connect()) as conn:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO watermarks (tenant, staging, n_records, last_updated, "
+                                 "updated_at) VALUES (?, ?, ?, ?, ?)",
+                                 [(tenant, staging, i['n_records'], i['last_updated'], now)
+                                  for staging, i in watermarks.items()])
+
+    def get_watermarks(self, tenant):
+        """
+        Returns: dict
+            staging -> {'n_records': int, 'last_updated': str or None}, recorded by the last successful run.
+        """
+        r = self._execute("SELECT staging, n_records, last_updated FROM watermarks WHERE tenant = ?", (tenant,))
+        return {staging: {'n_records': n_records, 'last_updated': last_updated}
+                for staging, n_records, last_updated in r}
+
+    def get_nodes(self, tenant):
+        """
+        Returns: dict
+            node -> (task id, status) for the pipeline nodes of the current run.
+        """
+        r = self._execute("SELECT node, task_id, status FROM nodes WHERE tenant = ?", (tenant,))
+        return {node: (task_id, status) for node, task_id, status in r}
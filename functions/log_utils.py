@@ -0,0 +1,199 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener
+
+from slacker_log_handler import SlackerLogHandler
+
+from .sheet_utils import RateLimiter
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_lock = threading.Lock()
+_phases = {}  # tenant -> current phase.
+_queue_handler = None
+_listener = None
+_digest = None
+
+
+class TenantQueueHandler(QueueHandler):
+    """
+    Queue handler stamping each record with the current phase of its tenant.
+    """
+
+    def prepare(self, record):
+        record.phase = _phases.get(record.name, '')
+        return super().prepare(record)
+
+
+class SlackDigestHandler(logging.Handler):
+    """
+    Send records to Slack as digests, one message per tenant and phase.
+
+    Records are only buffered by `emit`. Every `interval` seconds a thread posts the buffered records of
+    each (tenant, phase), identical messages collapsed with their count. Posts are limited by a token
+    bucket, groups not sent are kept for the next flush. Each group keeps at most `max_records`
+    distinct messages, older ones are dropped.
+
+    Args:
+        slack_handler: logging.Handler
+            Handler posting to Slack, called once per digest.
+        interval: float
+            Seconds between digests.
+        rate: float
+            Slack posts per second.
+        capacity: int
+            Max burst of Slack posts.
+        max_records: int
+            Max distinct messages per digest.
+
+    """
+
+    def __init__(self, slack_handler, interval=30, rate=0.5, capacity=5, max_records=20):
+        super().__init__(level=slack_handler.level)
+        self.slack_handler = slack_handler
+        self.interval = interval
+        self.limiter = RateLimiter(rate=rate, capacity=capacity)
+        self.max_records = max_records
+        self._groups = OrderedDict()  # (tenant, phase) -> {message: [count, level]}, dropped
+        self._buffer_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def emit(self, record):
+        message = record.getMessage()
+        key = (record.name, getattr(record, 'phase', ''))
+        with self._buffer_lock:
+            messages, dropped = self._groups.get(key, (OrderedDict(), 0))
+            if message in messages:
+                messages[message][0] += 1
+                messages[message][1] = max(messages[message][1], record.levelno)
+            else:
+                messages[message] = [1, record.levelno]
+                if len(messages) > self.max_records:
+                    messages.popitem(last=False)
+                    dropped += 1
+            self._groups[key] = (messages, dropped)
+
+    def _post(self, tenant, phase, messages, dropped):
+        level = max(level for _, level in messages.values())
+        lines = [f'{message} (x{count})' if count > 1 else message for message, (count, _) in messages.items()]
+        if dropped:
+            lines.append(f'... {dropped} older messages dropped')
+        title = f'[{phase}] ' if phase else ''
+        record = logging.makeLogRecord({'name': tenant, 'levelno': level, 'levelname': logging.getLevelName(level),
+                                        'msg': title + '\n'.join(lines), 'created': time.time()})
+        self.slack_handler.handle(record)
+
+    def flush(self, block=False):
+        """
+        Post the buffered digests. If not `block`, groups without a token left are kept for the next flush.
+        """
+        with self._buffer_lock:
+            groups, self._groups = self._groups, OrderedDict()
+        pending = OrderedDict()
+        for (tenant, phase), (messages, dropped) in groups.items():
+            if pending or not (block or self.limiter.try_acquire()):
+                pending[(tenant, phase)] = (messages, dropped)
+                continue
+            if block:
+                self.limiter.acquire()
+            try:
+                self._post(tenant, phase, messages, dropped)
+            except Exception:
+                self.handleError(logging.makeLogRecord({'msg': f'slack digest of {tenant}'}))
+        if pending:
+            with self._buffer_lock:
+                # Keep the order: older digests first.
+                for key, (messages, dropped) in self._groups.items():
+                    if key in pending:
+                        old_messages, old_dropped = pending[key]
+                        for message, (count, level) in messages.items():
+                            count_level = old_messages.setdefault(message, [0, level])
+                            count_level[0] += count
+                            count_level[1] = max(count_level[1], level)
+                        pending[key] = (old_messages, old_dropped + dropped)
+                    else:
+                        pending[key] = (messages, dropped)
+                self._groups = pending
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.flush(block=True)
+        super().close()
+
+
+def set_phase(tenant, phase):
+    """
+    Phase the next records of `tenant` are grouped under in the Slack digests.
+    """
+    _phases[tenant] = phase
+
+
+def setup_logging(slack_token=None, channel='#techfin-reprocess', username='TechFinBot', interval=30, rate=0.5):
+    """
+    Start the logging listener, once per process.
+
+    Tenant loggers only put records in a queue. A listener thread writes them to the console and, if
+    `slack_token` is given, to the Slack digests.
+
+    Returns: logging.handlers.QueueHandler
+        Handler to add to the tenant loggers.
+
+    """
+    global _queue_handler, _listener, _digest
+    with _lock:
+        if _queue_handler is not None:
+            return _queue_handler
+
+        handlers = []
+        console = logging.StreamHandler()
+        console.setLevel(logging.DEBUG)
+        handlers.append(console)
+        if slack_token:
+            slack_handler = SlackerLogHandler(slack_token, channel, username=username)
+            slack_handler.setLevel(logging.INFO)
+            slack_handler.setFormatter(logging.Formatter(FORMAT))
+            _digest = SlackDigestHandler(slack_handler, interval=interval, rate=rate)
+            handlers.append(_digest)
+
+        log_queue = queue.SimpleQueue()
+        _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        _queue_handler = TenantQueueHandler(log_queue)
+        atexit.register(stop_logging)
+        return _queue_handler
+
+
+def stop_logging():
+    """
+    Stop the listener and send the pending Slack digests.
+    """
+    global _queue_handler, _listener, _digest
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+        if _digest is not None:
+            _digest.close()
+        _queue_handler = _listener = _digest = None
+
+
+def get_logger(domain, slack_token=None):
+    """
+    Logger of a tenant. The queue handler is only added once, whatever the number of runs of the tenant.
+    """
+    handler = setup_logging(slack_token)
+    logger = logging.getLogger(domain)
+    if handler not in logger.handlers:
+        logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    return logger
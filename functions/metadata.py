@@ -0,0 +1,67 @@
+import threading
+
+from pycarol import Apps, Connectors, DataModel
+
+from . import carol_task
+
+
+class TenantMetadata:
+    """
+    Memoized name -> id lookups of a tenant.
+
+    Created once per tenant run and passed to the functions doing the lookups. Functions mutating the
+    tenant (dropping stagings, ETLs, installing the app) call `invalidate` for what they changed.
+
+    Running states (ETLs/mappings playing or paused) are never cached.
+
+    Args:
+        login: pycarol.Carol
+            Carol() instance.
+
+    """
+
+    def __init__(self, login):
+        self.login = login
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key, func, *args, **kwargs):
+        with self._lock:
+            if key in self._cache:
+                return self._cache[key]
+        value = func(*args, **kwargs)
+        with self._lock:
+            return self._cache.setdefault(key, value)
+
+    def invalidate(self, *kinds):
+        """
+        Drop cached values of the given kinds (`connector_id`, `dm_id`, `stagings`, `etls`,
+        `entity_mappings`, `app_version`). Drop everything if no kind is given.
+        """
+        with self._lock:
+            if not kinds:
+                self._cache = {}
+            else:
+                self._cache = {k: v for k, v in self._cache.items() if k[0] not in kinds}
+
+    def connector_id(self, connector_name):
+        return self._get(('connector_id', connector_name),
+                         lambda: Connectors(self.login).get_by_name(connector_name)['mdmId'])
+
+    def dm_id(self, dm_name):
+        return self._get(('dm_id', dm_name), lambda: DataModel(self.login).get_by_name(dm_name)['mdmId'])
+
+    def stagings(self, connector_name):
+        return self._get(('stagings', connector_name), carol_task.get_all_stagings, self.login, connector_name)
+
+    def etls(self, connector_name):
+        # For ids and source stagings only, `mdmRunningState` is not kept up to date.
+        return self._get(('etls', connector_name), carol_task.get_all_etls, self.login, connector_name,
+                         metadata=self)
+
+    def entity_mappings(self, connector_name, staging_name):
+        return self._get(('entity_mappings', connector_name, staging_name), carol_task.check_mapping,
+                         self.login, connector_name, staging_name)
+
+    def app_version(self, app_name):
+        return self._get(('app_version', app_name), lambda: Apps(self.login).get_by_name(app_name)['mdmAppVersion'])
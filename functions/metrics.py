@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+
+class Span:
+    """
+    Timing of a phase of a tenant run, or of a node of the processing DAG.
+
+    `tasks` and `retries` are incremented by the code tracking the Carol tasks of the phase.
+    """
+
+    def __init__(self, tenant, phase, node=None):
+        self.tenant = tenant
+        self.phase = phase
+        self.node = node
+        self.started_at = time.time()
+        self.duration = None
+        self.tasks = 0
+        self.retries = 0
+        self.status = None
+
+    def to_dict(self):
+        return {'tenant': self.tenant, 'phase': self.phase, 'node': self.node, 'started_at': self.started_at,
+                'duration': self.duration, 'tasks': self.tasks, 'retries': self.retries, 'status': self.status}
+
+
+class Metrics:
+    """
+    Record spans as JSON lines and export their aggregates as a Prometheus textfile.
+
+    Each finished span is appended to `jsonl_path`. Durations, tasks, retries and failures are summed
+    per phase (and DAG node) and `prom_path` is rewritten, to be picked up by the node exporter
+    textfile collector.
+
+    Args:
+        jsonl_path: str
+            File the spans are appended to. If None, spans are not written.
+        prom_path: str
+            Prometheus textfile. If None, it is not written.
+        prefix: str
+            Prefix of the metric names.
+
+    """
+
+    def __init__(self, jsonl_path='spans.jsonl', prom_path='techfin_reprocess.prom', prefix='techfin_reprocess'):
+        self.jsonl_path = jsonl_path
+        self.prom_path = prom_path
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        # (phase, node, status) -> aggregates.
+        self._aggregates = defaultdict(lambda: {'count': 0, 'duration': 0.0, 'max': 0.0, 'tasks': 0, 'retries': 0})
+
+    def start(self, tenant, phase, node=None):
+        return Span(tenant, phase, node=node)
+
+    def finish(self, span, status='ok'):
+        span.duration = time.time() - span.started_at
+        span.status = status
+        with self._lock:
+            agg = self._aggregates[(span.phase, span.node or '', status)]
+            agg['count'] += 1
+            agg['duration'] += span.duration
+            agg['max'] = max(agg['max'], span.duration)
+            agg['tasks'] += span.tasks
+            agg['retries'] += span.retries
+            if self.jsonl_path is not None:
+                with open(self.jsonl_path, 'a') as f:
+                    f.write(json.dumps(span.to_dict()) + '\n')
+            if self.prom_path is not None:
+                self._write_prometheus()
+        return span
+
+    def summary(self):
+        """
+        Returns: dict
+            phase -> count, total duration, max duration, tasks and retries, over all nodes and status.
+        """
+        r = defaultdict(lambda: {'count': 0, 'duration': 0.0, 'max': 0.0, 'tasks': 0, 'retries': 0})
+        with self._lock:
+            for (phase, _, _), agg in self._aggregates.items():
+                for key in ('count', 'duration', 'tasks', 'retries'):
+                    r[phase][key] += agg[key]
+                r[phase]['max'] = max(r[phase]['max'], agg['max'])
+        return dict(r)
+
+    def _write_prometheus(self):
+        metrics = [
+            ('phase_duration_seconds', 'summary', 'Seconds spent in the phase.',
+             [('_sum', 'duration'), ('_count', 'count')]),
+            ('phase_duration_seconds_max', 'gauge', 'Longest run of the phase.', [('', 'max')]),
+            ('phase_tasks_total', 'counter', 'Carol tasks tracked by the phase.', [('', 'tasks')]),
+            ('phase_retries_total', 'counter', 'Carol task retries of the phase.', [('', 'retries')]),
+        ]
+        lines = []
+        for name, kind, description, samples in metrics:
+            name = f'{self.prefix}_{name}'
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            for (phase, node, status), agg in sorted(self._aggregates.items()):
+                labels = f'phase="{phase}",node="{node}",status="{status}"'
+                lines += [f'{name}{suffix}{{{labels}}} {agg[key]}' for suffix, key in samples]
+
+        # Write and rename, so the collector never reads a partial file.
+        tmp = f'{self.prom_path}.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, self.prom_path)
@@ -1,7 +1,13 @@
 import gspread
+from gspread.utils import rowcol_to_a1
 import datetime
 import time
-import random
+import logging
+import threading
+
+TENANT_HEADER = 'environmentName (tenantID)'
+SYNC_TYPE_COL = 4
+STATUS_COL = 9
 
 
 def get_client():
@@ -12,10 +18,165 @@ def get_client():
     return techfin_worksheet
 
 
+class RateLimiter:
+    """
+    Token bucket shared by all threads writing to the sheet.
+
+    Args:
+        rate: float
+            Tokens added per second.
+        capacity: int
+            Max number of tokens in the bucket.
+
+    """
+
+    def __init__(self, rate=0.8, capacity=5):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self):
+        # Returns 0 if a token was taken, otherwise the seconds until the next one.
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def try_acquire(self):
+        """
+        Take a token without waiting. Returns: bool, True if taken.
+        """
+        return not self._take()
+
+
+# Google Sheets quota is per user, so all workers share the same bucket.
+rate_limiter = RateLimiter()
+
+
+class SheetWriter:
+    """
+    Write-behind buffer for a worksheet.
+
+    `update_cell` only stores the value, the last value of each cell is written with a single
+    `batch_update` on `flush`, which runs every `interval` seconds once `start` is called.
+
+    Args:
+        techfin_worksheet: gspread.Worksheet
+            Worksheet to write to.
+        interval: float
+            Seconds between flushes.
+        limiter: RateLimiter
+            Rate limiter used before each request.
+
+    """
+
+    def __init__(self, techfin_worksheet, interval=10, limiter=None):
+        self.worksheet = techfin_worksheet
+        self.interval = interval
+        self.limiter = limiter or rate_limiter
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __getattr__(self, name):
+        # Reads go straight to the worksheet.
+        return getattr(self.worksheet, name)
+
+    def update_cell(self, row, col, value):
+        with self._lock:
+            self._pending[(row, col)] = value
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        data = [{'range': rowcol_to_a1(row, col), 'values': [[value]]}
+                for (row, col), value in pending.items()]
+        self.limiter.acquire()
+        try:
+            self.worksheet.batch_update(data, value_input_option='USER_ENTERED')
+        except Exception:
+            with self._lock:
+                # Keep newer values written while flushing.
+                self._pending = {**pending, **self._pending}
+            raise
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                logging.getLogger(__name__).warning("error flushing sheet updates", exc_info=1)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
+def _update_cell(techfin_worksheet, row, col, value):
+    if not isinstance(techfin_worksheet, SheetWriter):
+        rate_limiter.acquire()
+    techfin_worksheet.update_cell(row, col, value)
+
+
+def build_index(techfin_worksheet):
+    """
+    Read the whole sheet once and index it by tenant.
+
+    Args:
+        techfin_worksheet: gspread.Worksheet
+            Status worksheet.
+
+    Returns: dict
+        tenant -> {'row': row number, 'status': status, 'sync_type': sync type}
+
+    """
+    rate_limiter.acquire()
+    values = techfin_worksheet.get_all_values()
+    header = values[0]
+    tenant_col = header.index(TENANT_HEADER)
+
+    index = {}
+    for row, row_values in enumerate(values[1:], start=2):
+        row_values = row_values + [''] * (len(header) - len(row_values))
+        tenant = row_values[tenant_col].strip()
+        if not tenant:
+            continue
+        index[tenant] = {'row': row,
+                         'status': row_values[STATUS_COL - 1].strip(),
+                         'sync_type': row_values[SYNC_TYPE_COL - 1].strip()}
+    return index
+
+
 def find_tenant(techfin_worksheet, domain):
-    time.sleep(round(1 + random.random() * 3, 2))
     if techfin_worksheet is None:
         return
+    rate_limiter.acquire()
     try:
         match = techfin_worksheet.find(domain)
         return match
@@ -24,36 +185,29 @@ def find_tenant(techfin_worksheet, domain):
 
 
 def update_status(techfin_worksheet, row, status):
-    time.sleep(round(1 + random.random() * 3, 2))
-    col = 9
-    techfin_worksheet.update_cell(row, col, status)
+    _update_cell(techfin_worksheet, row, STATUS_COL, status)
 
 
 def get_sync_type(techfin_worksheet, row):
-    time.sleep(round(1 + random.random() * 3, 2))
-    col = 4
-    return techfin_worksheet.cell(row, col).value
+    rate_limiter.acquire()
+    return techfin_worksheet.cell(row, SYNC_TYPE_COL).value
 
 
 def update_task_id(techfin_worksheet, row, status):
-    time.sleep(round(1 + random.random() * 3, 2))
     col = 8
-    techfin_worksheet.update_cell(row, col, status)
+    _update_cell(techfin_worksheet, row, col, status)
 
 
 def update_start_time(techfin_worksheet, row):
-    time.sleep(round(1 + random.random() * 3, 2))
     col = 6
-    techfin_worksheet.update_cell(row, col, str(datetime.datetime.utcnow())[:-7])
+    _update_cell(techfin_worksheet, row, col, str(datetime.datetime.utcnow())[:-7])
 
 
 def update_end_time(techfin_worksheet, row):
-    time.sleep(round(1 + random.random() * 3, 2))
     col = 7
-    techfin_worksheet.update_cell(row, col, str(datetime.datetime.utcnow())[:-7])
+    _update_cell(techfin_worksheet, row, col, str(datetime.datetime.utcnow())[:-7])
 
 
 def update_version(techfin_worksheet, row, version):
-    time.sleep(round(1 + random.random() * 3, 2))
     col = 3
-    techfin_worksheet.update_cell(row, col, version)
+    _update_cell(techfin_worksheet, row, col, version)
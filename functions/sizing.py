@@ -0,0 +1,145 @@
+import sqlite3
+import statistics
+import time
+from contextlib import closing
+
+# vCPUs per worker type.
+WORKER_TYPES = {'n1-highmem-4': 4, 'n1-highmem-8': 8, 'n1-highmem-16': 16}
+WORKERS = [4, 8, 16]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sizing (
+    task_id TEXT PRIMARY KEY,
+    tenant TEXT,
+    staging TEXT,
+    task_type TEXT NOT NULL,
+    n_records INTEGER NOT NULL,
+    worker_type TEXT NOT NULL,
+    number_shards INTEGER NOT NULL,
+    max_number_workers INTEGER NOT NULL,
+    started_at REAL NOT NULL,
+    duration REAL
+);
+"""
+
+
+def default_sizing(n_records):
+    """
+    Sizing used when there is no history.
+
+    Args:
+        n_records: int
+            Number of records in the staging.
+
+    Returns: dict
+        worker_type, number_shards and max_number_workers.
+
+    """
+    if n_records > 5000000:
+        worker_type = 'n1-highmem-16'
+        max_number_workers = 16
+    else:
+        worker_type = 'n1-highmem-4'
+        max_number_workers = 16
+    number_shards = round(n_records / 100000) + 1
+    number_shards = max(16, number_shards)
+    return {'worker_type': worker_type, 'number_shards': number_shards, 'max_number_workers': max_number_workers}
+
+
+class SizingHistory:
+    """
+    History of the resources used by consolidate/process tasks, used to size the next ones.
+
+    Each task is recorded with the number of records, the resources chosen and, once completed, its
+    duration. From the history a throughput (records per vCPU second) is estimated per task type, and the
+    cheapest configuration expected to finish within `target_duration` is chosen.
+
+    Args:
+        path: str
+            SQLite database file.
+        target_duration: float
+            Expected duration, in seconds, of a task.
+        overhead: float
+            Fixed time, in seconds, of a task regardless of its size (cluster start, etc).
+        min_samples: int
+            Min number of completed tasks of a type before the history is used.
+
+    """
+
+    def __init__(self, path='sizing.db', target_duration=1800, overhead=300, min_samples=5):
+        self.path = path
+        self.target_duration = target_duration
+        self.overhead = overhead
+        self.min_samples = min_samples
+        with closing(self._connect()) as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _execute(self, query, params=()):
+        with closing(self._connect()) as conn:
+            with conn:
+                return conn.execute(query, params).fetchall()
+
+    def throughput(self, task_type):
+        """
+        Median records per vCPU second of the completed tasks of `task_type`, None if not enough history.
+        """
+        r = self._execute("SELECT n_records, worker_type, max_number_workers, duration FROM sizing "
+                          "WHERE task_type = ? AND duration IS NOT NULL ORDER BY started_at DESC LIMIT 200",
+                          (task_type,))
+        rates = [n_records / (max(duration - self.overhead, 1) * WORKER_TYPES.get(worker_type, 4) * workers)
+                 for n_records, worker_type, workers, duration in r if n_records > 0]
+        if len(rates) < self.min_samples:
+            return None
+        return statistics.median(rates)
+
+    def choose(self, task_type, n_records, default=None):
+        """
+        Resources for a task of `task_type` over `n_records` records.
+
+        Args:
+            default: dict
+                Resources used when there is not enough history. If None, uses `default_sizing`.
+
+        Returns: dict
+            worker_type, number_shards and max_number_workers.
+
+        """
+        rate = self.throughput(task_type)
+        if rate is None:
+            return default if default is not None else default_sizing(n_records)
+
+        candidates = sorted(((cpus * workers, worker_type, workers)
+                             for worker_type, cpus in WORKER_TYPES.items() for workers in WORKERS))
+        for total_cpus, worker_type, workers in candidates:
+            if self.overhead + n_records / (rate * total_cpus) <= self.target_duration:
+                break
+        number_shards = max(workers, round(n_records / 100000) + 1)
+        return {'worker_type': worker_type, 'number_shards': number_shards, 'max_number_workers': workers}
+
+    def tenant_records(self):
+        """
+        Returns: dict
+            tenant -> number of records of its stagings, from their last task.
+        """
+        r = self._execute("SELECT tenant, SUM(n_records) FROM sizing s WHERE tenant IS NOT NULL AND started_at = "
+                          "(SELECT MAX(started_at) FROM sizing WHERE tenant = s.tenant AND staging = s.staging) "
+                          "GROUP BY tenant")
+        return dict(r)
+
+    def start(self, task_id, task_type, n_records, sizing, tenant=None, staging=None):
+        self._execute("INSERT OR REPLACE INTO sizing (task_id, tenant, staging, task_type, n_records, worker_type, "
+                      "number_shards, max_number_workers, started_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                      (task_id, tenant, staging, task_type, n_records, sizing['worker_type'],
+                       sizing['number_shards'], sizing['max_number_workers'], time.time()))
+
+    def finish(self, task_ids):
+        """
+        Record the duration of completed tasks. Tasks not started through `start` are ignored.
+        """
+        now = time.time()
+        for task_id in task_ids:
+            self._execute("UPDATE sizing SET duration = ? - started_at WHERE task_id = ? AND duration IS NULL",
+                          (now, task_id))
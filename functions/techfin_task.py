@@ -1,10 +1,22 @@
 from urllib3.util.retry import Retry
+from email.utils import parsedate_to_datetime
+import asyncio
+import datetime
+import random
 import requests
 import os
+import threading
 from requests.adapters import HTTPAdapter
 
+TECHFIN_URL = os.environ.get('TECHFIN_URL', 'https://cashflow.totvs.app')
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
 def retry_session(retries=7, session=None, backoff_factor=1, status_forcelist=(500, 502, 503, 504, 524),
-                   method_whitelist=frozenset(['HEAD', 'TRACE', 'GET', 'PUT', 'OPTIONS', 'DELETE'])):
+                   method_whitelist=frozenset(['HEAD', 'TRACE', 'GET', 'PUT', 'OPTIONS', 'DELETE']),
+                   pool_maxsize=10):
 
     """
     Static method used to handle retries between calls.
@@ -24,6 +36,8 @@ def retry_session(retries=7, session=None, backoff_factor=1, status_forcelist=(5
             status_forcelist.
         method_whitelist: `iterable` , default frozenset(['HEAD', 'TRACE', 'GET', 'PUT', 'OPTIONS', 'DELETE']))
             Set of uppercased HTTP method verbs that we should retry on.
+        pool_maxsize: `int` , default `10`
+            Max number of connections kept open per host.
 
     Returns:
         :class:`requests.Section`
@@ -38,43 +52,210 @@ def retry_session(retries=7, session=None, backoff_factor=1, status_forcelist=(5
         status_forcelist=status_forcelist,
         method_whitelist=method_whitelist,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(max_retries=retry, pool_maxsize=pool_maxsize)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     return session
 
 
+def get_session(name, **kwargs):
+    """
+    Session shared by all threads for the requests of `name`, so connections are reused.
+
+    Args:
+        name: str
+            Session name, one per retry configuration.
+        **kwargs:
+            `retry_session` arguments, only used the first time.
+
+    Returns:
+        :class:`requests.Session`
+    """
+    with _sessions_lock:
+        if name not in _sessions:
+            _sessions[name] = retry_session(**kwargs)
+        return _sessions[name]
+
+
+def get_headers():
+    bearer_token = os.environ['TOKEN_TECHFIN']
+    return {"Authorization": f"Bearer {bearer_token}", 'accept': '/' ,"content-type": 'application/json'}
+
+
 def get_guid(tenant):
     tenant = tenant[6:]
     uuid_tenant = tenant[:8] + '-' + tenant[8:12] + '-' + tenant[12:16] + '-' + tenant[16:20] + '-' + tenant[20:]
     return uuid_tenant
 
-def add_pubsub(tenant):
+def _subscribe(tenants):
+    payload = {"tenantIds": [get_guid(i) for i in tenants], "defaultMaxInFlight": 1,"defaultMaxBatchSize": 100,
+               "defaultStartAt": 0, "clearDelayedSubscriptions":True, "pause":False}
+    session = get_session('subscribe', method_whitelist=frozenset(['POST']), status_forcelist=frozenset([504]),
+                          pool_maxsize=32)
+    try:
+        r = session.post(url=f'{TECHFIN_URL}/carol-sync/api/v1/subscription/subscribe', json=payload,
+                         headers=get_headers(), )
+    except requests.RequestException as e:
+        return {i: {'success': False, 'status_code': None, 'error': str(e)} for i in tenants}
 
+    if r.ok:
+        return {i: {'success': True, 'status_code': r.status_code, 'error': None} for i in tenants}
+    if 400 <= r.status_code < 500 and r.status_code != 429 and len(tenants) > 1:
+        # Rejected batch, split it to find the tenants causing it.
+        half = len(tenants) // 2
+        return {**_subscribe(tenants[:half]), **_subscribe(tenants[half:])}
+    return {i: {'success': False, 'status_code': r.status_code, 'error': r.text} for i in tenants}
 
-    uuid_tenant = get_guid(tenant)
-    bearer_token = os.environ['TOKEN_TECHFIN']
-    api = 'https://cashflow.totvs.app/carol-sync/api/v1/subscription/subscribe'
-    header = {"Authorization": f"Bearer {bearer_token}", 'accept': '/' ,"content-type": 'application/json'}
-    payload = {"tenantIds": [uuid_tenant], "defaultMaxInFlight": 1,"defaultMaxBatchSize": 100,
-               "defaultStartAt": 0, "clearDelayedSubscriptions":True, "pause":False}
 
-    session = retry_session(method_whitelist=frozenset(['POST']), status_forcelist=frozenset([504]),)
-    r = session.post(url=api, json=payload, headers=header, )
+def add_pubsub(tenants, batch_size=100):
+    """
+    Subscribe tenants to the techfin pub/sub, `batch_size` tenants per request.
 
-    return r
+    Args:
+        tenants: list or str
+            Tenant names.
+        batch_size: int
+            Max tenants per request.
 
-def delete_payments(tenant):
+    Returns: dict
+        tenant -> {'success': bool, 'status_code': HTTP status or None, 'error': error message or None}
 
-    uuid_tenant = get_guid(tenant)
-    bearer_token = os.environ['TOKEN_TECHFIN']
-    api = f'https://cashflow.totvs.app/provisioner/api/v1/carol-sync-monitoring/{uuid_tenant}/delete-payments'
-    header = {"Authorization": f"Bearer {bearer_token}", 'accept': '/' ,"content-type": 'application/json'}
+    """
+    if isinstance(tenants, str):
+        tenants = [tenants]
+    tenants = list(tenants)
+
+    results = {}
+    for i in range(0, len(tenants), batch_size):
+        results.update(_subscribe(tenants[i:i + batch_size]))
+    return results
 
-    session = retry_session(method_whitelist=frozenset(['POST']),)
-    r = session.post(url=api, headers=header, )
 
-    return r
+def _retry_after(response):
+    """
+    Seconds from the Retry-After header, None if missing or invalid.
+    """
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0., (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+class PaymentsClient:
+    """
+    Async client of the techfin delete payments endpoint.
+
+    Requests run in the default executor, at most `max_concurrency` at the same time. 429, 5xx and
+    connection errors are retried with full jitter exponential backoff. A Retry-After header is honored
+    and pauses every request of the client, so throttled tenants do not retry all at once.
+
+    Args:
+        max_concurrency: int
+            Max number of requests at the same time.
+        max_retries: int
+            Max number of retries per tenant.
+        backoff_factor: float
+            Base of the backoff, the n-th retry waits up to `backoff_factor * 2 ** n` seconds.
+        max_backoff: float
+            Max seconds between retries.
+        timeout: float
+            Request timeout in seconds.
+
+    """
+
+    retry_status = frozenset([429, 500, 502, 503, 504, 524])
 
+    def __init__(self, max_concurrency=5, max_retries=7, backoff_factor=1, max_backoff=120, timeout=60):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self._loop = None
+        self._semaphore = None
+        self._not_before = 0  # loop time before which no request is sent.
 
+    def _check_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._not_before = 0
+        return loop
 
+    def _post(self, tenant):
+        session = get_session('payments', retries=0, pool_maxsize=max(10, self.max_concurrency))
+        api = f'{TECHFIN_URL}/provisioner/api/v1/carol-sync-monitoring/{get_guid(tenant)}/delete-payments'
+        return session.post(url=api, headers=get_headers(), timeout=self.timeout)
+
+    async def delete(self, tenant):
+        """
+        Returns: dict
+            {'success': bool, 'status_code': HTTP status or None, 'error': error message or None,
+             'attempts': number of requests}
+        """
+        loop = self._check_loop()
+        attempt = 0
+        while True:
+            attempt += 1
+            retry_after = None
+            async with self._semaphore:
+                wait = self._not_before - loop.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                try:
+                    r = await loop.run_in_executor(None, self._post, tenant)
+                except requests.RequestException as e:
+                    status_code, error = None, str(e)
+                else:
+                    if r.ok:
+                        return {'success': True, 'status_code': r.status_code, 'error': None, 'attempts': attempt}
+                    status_code, error = r.status_code, r.text
+                    retry_after = _retry_after(r)
+                    if status_code not in self.retry_status:
+                        return {'success': False, 'status_code': status_code, 'error': error, 'attempts': attempt}
+
+            if attempt > self.max_retries:
+                return {'success': False, 'status_code': status_code, 'error': error, 'attempts': attempt}
+            if retry_after is not None:
+                self._not_before = max(self._not_before, loop.time() + retry_after)
+                delay = retry_after + random.uniform(0, self.backoff_factor)
+            else:
+                delay = random.uniform(0, min(self.max_backoff, self.backoff_factor * 2 ** attempt))
+            await asyncio.sleep(delay)
+
+    async def delete_many(self, tenants):
+        """
+        Returns: dict
+            tenant -> result of `delete`.
+        """
+        results = await asyncio.gather(*(self.delete(i) for i in tenants))
+        return dict(zip(tenants, results))
+
+
+def delete_payments(tenants, **kwargs):
+    """
+    Delete the techfin payments of a tenant or of a wave of tenants, see `PaymentsClient`.
+
+    Args:
+        tenants: list or str
+            Tenant names.
+        **kwargs:
+            `PaymentsClient` arguments.
+
+    Returns: dict
+        tenant -> {'success': bool, 'status_code': HTTP status or None, 'error': error message or None,
+                   'attempts': number of requests}
+
+    """
+    if isinstance(tenants, str):
+        tenants = [tenants]
+    return asyncio.run(PaymentsClient(**kwargs).delete_many(list(tenants)))
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('pycarol')
+
+from functions import admission, engine
+
+
+@pytest.fixture
+def controller(tmp_path):
+    return admission.AdmissionController(str(tmp_path / 'admission.db'), capacity=10)
+
+
+def test_slots_are_admitted_in_arrival_order(controller):
+    assert controller.try_acquire('a/se1/process', 6, tenant='a')
+    assert not controller.try_acquire('b/se1/process', 6, tenant='b')
+    # Fits in the capacity, but waits for the request ahead of it.
+    assert not controller.try_acquire('c/se1/process', 2, tenant='c')
+    assert controller.in_flight() == (6, 8)
+
+    controller.attach('a/se1/process', 'task-a')
+    controller.release_tasks(['task-a'])
+    assert controller.try_acquire('b/se1/process', 6, tenant='b')
+    assert controller.try_acquire('c/se1/process', 2, tenant='c')
+    assert controller.in_flight() == (8, 0)
+
+
+def test_heavy_task_is_admitted_alone(controller):
+    assert controller.try_acquire('a/se1/process', 40, tenant='a')
+    assert not controller.try_acquire('b/se1/process', 1, tenant='b')
+    controller.release('a/se1/process')
+    assert controller.try_acquire('b/se1/process', 1, tenant='b')
+
+
+def test_tenant_slots_are_released(controller):
+    assert controller.try_acquire('a/se1/process', 4, tenant='a')
+    assert controller.try_acquire('a/se2/process', 4, tenant='a')
+    assert controller.try_acquire('b/se1/process', 2, tenant='b')
+    assert not controller.try_acquire('a/fk1/process', 4, tenant='a')
+
+    controller.release_tenant('a')
+    assert controller.in_flight() == (2, 0)
+
+
+def test_leaked_admitted_slots_age_out(tmp_path):
+    controller = admission.AdmissionController(str(tmp_path / 'admission.db'), capacity=10)
+    assert controller.try_acquire('a/se1/process', 10, tenant='a')
+    controller.attach('a/se1/process', 'task-a')
+    assert not controller.try_acquire('b/se1/process', 10, tenant='b')
+
+    # The process tracking task-a died, its slot is dropped once too old.
+    controller.admitted_ttl = 0
+    assert controller.try_acquire('b/se1/process', 10, tenant='b')
+
+
+def test_failed_tenant_run_releases_its_slots(controller, monkeypatch):
+    reprocess = engine.Engine(admission=controller, time_scale=0)
+
+    async def _start(self):
+        assert controller.try_acquire(f'{self.domain}/se1/consolidate', 4, tenant=self.domain)
+        raise RuntimeError('boom')
+
+    monkeypatch.setattr(engine.TenantRun, '_start', _start)
+    run = engine.TenantRun(reprocess, 'tenant')
+    asyncio.run(run.run())
+
+    assert run.state == 'failed'
+    assert controller.in_flight() == (0, 0)
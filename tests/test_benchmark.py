@@ -0,0 +1,25 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('toposort')
+pytest.importorskip('pycarol')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.mark.skipif(shutil.which('openssl') is None, reason='openssl is needed for the fake Carol certificate')
+def test_benchmark_reprocesses_a_tenant(tmp_path):
+    output = tmp_path / 'results.json'
+    subprocess.run([sys.executable, '-m', 'benchmark.run', '--tenants', '1', '--concurrency', '1',
+                    '--time-scale', '0.01', '--task-scale', '0.01', '--state-lag', '0.05',
+                    '--records', '1000', '10000', '--port', '0', '--output', str(output)],
+                   cwd=ROOT, check=True, capture_output=True, timeout=600)
+
+    [result] = json.loads(output.read_text())
+    assert result['status'] == {'Done': 1}
+    assert 'unmatched' not in result['api_calls_per_route']
@@ -0,0 +1,27 @@
+import json
+
+import pytest
+
+pytest.importorskip('pycarol')
+
+from pycarol.exceptions import CarolApiResponseException
+
+from functions import carol_login
+
+
+class Login:
+    def __init__(self, error):
+        self.error = error
+
+    def api_key_details(self, api_key, connector_id):
+        raise self.error
+
+
+def test_only_unauthorized_invalidates_the_key():
+    unauthorized = CarolApiResponseException(json.dumps({'errorCode': 401, 'errorMessage': 'Invalid API key'}))
+    assert not carol_login._is_valid(Login(unauthorized), 'key', 'connector')
+
+    # A server error mentioning 401 does not drop the key.
+    error = CarolApiResponseException(json.dumps({'errorCode': 500, 'errorMessage': 'timeout on 8f401a'}))
+    with pytest.raises(CarolApiResponseException):
+        carol_login._is_valid(Login(error), 'key', 'connector')
@@ -0,0 +1,21 @@
+import json
+
+import pytest
+
+pytest.importorskip('pycarol')
+
+from pycarol.exceptions import CarolApiResponseException
+
+from functions import carol_task
+
+
+def api_error(code, message):
+    return CarolApiResponseException(json.dumps({'errorCode': code, 'errorMessage': message}))
+
+
+def test_not_found_uses_the_error_code():
+    assert carol_task._is_not_found(api_error(404, 'ETL not found'))
+    # An id containing 404 in a server error is not a 404.
+    assert not carol_task._is_not_found(api_error(500, 'error deleting ETL 8f404a1c2b'))
+    assert not carol_task._is_not_found(ValueError('404'))
+    assert not carol_task._is_not_found(CarolApiResponseException('<html>Not Found</html>'))
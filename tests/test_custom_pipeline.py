@@ -0,0 +1,152 @@
+import pytest
+
+pytest.importorskip('toposort')
+pytest.importorskip('pycarol')
+
+from functions import admission, custom_pipeline
+
+
+def test_dirty_dm_reprocesses_all_its_inputs():
+    relations = custom_pipeline.get_relations()
+    dirty = custom_pipeline.get_dirty(['se1_payments'], relations)
+
+    # The golden of DM_arinvoicepayments is deleted, every node feeding it must be processed again.
+    assert 'DM_arinvoicepayments' in dirty
+    assert relations['DM_arinvoicepayments'] <= dirty
+    for node in ('fk1', 'fkd_1', 'se1_acresc', 'sea_1_frv_descontado_deletado_invoicepayment'):
+        assert node in dirty
+
+    # The CDS data of se1_payments is generated by processing se1.
+    assert 'se1' in dirty
+
+    # Closed upward and downstream.
+    for node in dirty:
+        deps = relations.get(node, set())
+        if node.startswith('DM_'):
+            assert deps <= dirty
+        else:
+            assert {i for i in deps if not i.startswith('DM_')} <= dirty
+    assert custom_pipeline.get_downstream(dirty, relations) == dirty
+
+    # The AP side does not depend on se1_payments.
+    assert not {'se2', 'se2_payments', 'DM_apinvoice', 'DM_apinvoicepayments'} & dirty
+
+
+def test_unchanged_pipeline_is_clean():
+    assert custom_pipeline.get_dirty([]) == set()
+
+
+def test_scheduler_processes_all_inputs_of_a_deleted_dm(monkeypatch):
+    relations = custom_pipeline.get_relations()
+    nodes = set(relations) | set().union(*relations.values())
+    dirty = custom_pipeline.get_dirty(['se1_payments'], relations)
+
+    class Login:
+        domain = 'tenant'
+
+    played = []
+    processed = []
+    monkeypatch.setattr(custom_pipeline.carol_task, 'par_resume_process',
+                        lambda login, staging_list, **kwargs: played.extend(staging_list) or
+                        {i: {'success': True} for i in staging_list})
+    monkeypatch.setattr(custom_pipeline.carol_task, 'get_playing',
+                        lambda login, connector_name, staging_list, **kwargs: set(staging_list))
+    monkeypatch.setattr(custom_pipeline.carol_task, 'check_tasks',
+                        lambda login, task_list, *args, **kwargs: ({'COMPLETED': list(task_list)}, True, False))
+    monkeypatch.setattr(custom_pipeline.DagScheduler, 'process',
+                        lambda self, staging_name: processed.append(staging_name) or f'task-{staging_name}')
+
+    scheduler = custom_pipeline.DagScheduler(Login(), 'protheus_carol', unchanged=nodes - dirty)
+    while not scheduler.poll():
+        pass
+
+    assert not scheduler.failed
+    assert scheduler.done == nodes
+    assert set(processed) == {i for i in dirty if not i.startswith('DM_')}
+    assert relations['DM_arinvoicepayments'] - {'DM_arinvoiceinstallment'} <= set(processed)
+
+
+class History:
+    def __init__(self, resources=None):
+        self.resources = resources
+
+    def choose(self, task_type, n_records, default=None):
+        return self.resources if self.resources is not None else default
+
+
+def test_resources_come_from_a_single_source():
+    small = {'worker_type': 'n1-highmem-4', 'number_shards': 4, 'max_number_workers': 4}
+    big = {'worker_type': 'n1-highmem-16', 'number_shards': 400, 'max_number_workers': 16}
+
+    # With history, the spec hints are not used.
+    assert custom_pipeline.get_resources('se1', 100000, sizing=History(small)) == dict(
+        small, recursive_processing=False)
+    assert custom_pipeline.get_resources('fk1', 40000000, sizing=History(big)) == dict(
+        big, recursive_processing=False)
+
+    # Without history, the hint of the node.
+    hint = custom_pipeline.get_resources('fk1', 100000, sizing=History())
+    assert (hint['worker_type'], hint['max_number_workers']) == ('n1-highmem-4', 4)
+    assert hint['number_shards'] == 4
+
+
+def test_pipeline_spec_rejects_partial_hints(tmp_path):
+    path = tmp_path / 'pipeline.json'
+    path.write_text('{"nodes": {"se1": {"depends_on": [], "number_shards": 10}}}')
+    with pytest.raises(custom_pipeline.PipelineError):
+        custom_pipeline.load_pipeline(str(path))
+
+
+def test_scheduler_writes_stores_only_on_flush(monkeypatch, tmp_path):
+    class Login:
+        domain = 'tenant'
+
+    class Journal:
+        def __init__(self):
+            self.nodes = {}
+
+        def set_node(self, tenant, node, status, task_id=None):
+            self.nodes[node] = status
+
+    class CDSStaging:
+        def __init__(self, login):
+            pass
+
+        def count(self, staging_name, connector_name):
+            return 1000
+
+        def process_data(self, staging_name, **kwargs):
+            return {'data': {'mdmId': f'task-{staging_name}'}}
+
+    monkeypatch.setattr(custom_pipeline, 'CDSStaging', CDSStaging)
+    monkeypatch.setattr(custom_pipeline.carol_task, 'par_resume_process',
+                        lambda login, staging_list, **kwargs: {i: {'success': True} for i in staging_list})
+    monkeypatch.setattr(custom_pipeline.carol_task, 'get_playing',
+                        lambda login, connector_name, staging_list, **kwargs: set(staging_list))
+    monkeypatch.setattr(custom_pipeline.carol_task, 'check_tasks',
+                        lambda login, task_list, *args, **kwargs: ({'COMPLETED': list(task_list)}, True, False))
+
+    relations = {'DM_a': {'s1'}}
+    journal = Journal()
+    slots = admission.AdmissionController(str(tmp_path / 'admission.db'))
+    scheduler = custom_pipeline.DagScheduler(Login(), 'protheus_carol', relations=relations, journal=journal,
+                                             admission=slots, nodes={})
+
+    scheduler.poll()  # plays s1
+    scheduler.poll()  # s1 is waiting for its slot
+    assert not scheduler.running and scheduler.queued == ['s1']
+    assert slots.in_flight() == (0, 0)
+
+    scheduler.flush()
+    assert slots.in_flight() == (1, 0)
+    scheduler.poll()
+    assert scheduler.running == {'task-s1': 's1'}
+    assert journal.nodes == {}
+
+    scheduler.flush()
+    assert journal.nodes == {'s1': 'RUNNING'}
+    while not scheduler.poll():
+        scheduler.flush()
+    scheduler.flush()
+    assert journal.nodes == {'s1': 'COMPLETED', 'DM_a': 'COMPLETED'}
+    assert slots.in_flight() == (0, 0)
@@ -0,0 +1,61 @@
+import asyncio
+import logging
+from collections import defaultdict
+
+import pytest
+
+pytest.importorskip('pycarol')
+
+from functions import engine, journal, metrics
+
+
+class Login:
+    domain = 'tenant'
+
+
+def completed(login, task_list, *args, **kwargs):
+    return defaultdict(list, COMPLETED=list(task_list)), True, False
+
+
+def test_stream_tasks_are_recorded_as_they_are_created(tmp_path, monkeypatch):
+    monkeypatch.setattr(engine.carol_task, 'check_tasks', completed)
+    store = journal.Journal(str(tmp_path / 'journal.db'))
+    store.start('tenant', 'delete_stagings')
+
+    def run(func):
+        run = engine.TenantRun(engine.Engine(journal=store, time_scale=0), 'tenant')
+        run.login, run.logger, run.state = Login(), logging.getLogger('tenant'), 'delete_stagings'
+        return run, asyncio.run(run.track_stream(func))
+
+    def interrupted(login):
+        yield 'task-a'
+        yield 'task-b'
+        raise RuntimeError('crash')
+
+    with pytest.raises(RuntimeError):
+        run(interrupted)
+    assert sorted(store.get_stream_tasks('tenant', 'delete_stagings')) == ['task-a', 'task-b']
+    assert store.get_tasks('tenant', 'delete_stagings') is None
+
+    # Resumed, the tasks of the interrupted stream are tracked along with the new ones.
+    resumed, fail = run(lambda login: iter(['task-c']))
+    assert not fail
+    assert sorted(resumed.task_list['COMPLETED']) == ['task-a', 'task-b', 'task-c']
+    assert sorted(store.get_tasks('tenant', 'delete_stagings')) == ['task-a', 'task-b', 'task-c']
+
+
+def test_failed_phase_of_a_tenant_not_in_the_sheet_is_recorded(tmp_path, monkeypatch):
+    store = journal.Journal(str(tmp_path / 'journal.db'))
+    spans = metrics.Metrics(jsonl_path=None, prom_path=None)
+
+    async def _start(self):
+        store.start(self.domain)
+        raise RuntimeError('tenant not found')
+
+    monkeypatch.setattr(engine.TenantRun, '_start', _start)
+    run = engine.TenantRun(engine.Engine(journal=store, metrics=spans, time_scale=0), 'tenant')
+    asyncio.run(run.run())
+
+    assert run.state == 'failed'
+    assert store.unfinished() == []
+    assert spans.summary()['start']['count'] == 1